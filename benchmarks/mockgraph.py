@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A local stand-in for graph.facebook.com, for benchmarks.
+
+MockGraphServer answers Graph API style requests without touching the
+network:
+
+    GET /{id}                   the object {"id": id, "name": ...}
+    GET /{id}/picture           a small JPEG image
+    GET /{id}/{connection}      a paged connection, following ?after=N
+    GET /?ids=a,b               a map from ID to object
+    POST / with batch=[...]     a batch response, one entry per request
+
+IDs starting with "missing" fail with a 404 and Graph API error 803,
+and every request is recorded in `log` as a (method, path, args) tuple.
+`connections` counts the connections the server has accepted.
+
+Its behaviour is set by MockGraphConfig: the latency added to every
+response, how many pages a connection has and how many items are on
+each page, the size of each item, the share of requests that fail
+with a given Graph API error code, and whether responses carry an ETag
+(in which case matching If-None-Match requests get a 304, counted in
+`not_modified`).
+
+    server = MockGraphServer(MockGraphConfig(latency=0.01, pages=5))
+    server.start()
+    graph = facebook.GraphAPI("token", base_url=server.url)
+
+"""
+
+import cgi
+import hashlib
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+
+class MockGraphConfig(object):
+    def __init__(self, latency=0, pages=1, page_size=25, item_size=100,
+                 error_rate=0, error_code=2, seed=None, etags=False):
+        # Seconds added to every response
+        self.latency = latency
+        # Number of pages of each connection
+        self.pages = pages
+        # Items on each page of a connection
+        self.page_size = page_size
+        # Approximate size in bytes of each object or item
+        self.item_size = item_size
+        # Share of requests (0 to 1) that fail with error_code
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.random = random.Random(seed)
+        # Whether JSON responses carry an ETag
+        self.etags = etags
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; don't let Nagle's
+    # algorithm hold the body back for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.app._lock:
+            self.server.app.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._respond(*self.server.app.handle("GET", self.path, {}))
+
+    def do_POST(self):
+        content_type = self.headers.get("content-type") or ""
+        if content_type.startswith("multipart/form-data"):
+            # Uploaded files are passed on as their contents
+            fields = cgi.FieldStorage(
+                fp=self.rfile, headers=self.headers,
+                environ={"REQUEST_METHOD": "POST",
+                         "CONTENT_TYPE": content_type})
+            form = dict((name, fields.getfirst(name)) for name in fields)
+        else:
+            length = int(self.headers.get("content-length") or 0)
+            body = self.rfile.read(length).decode("utf-8")
+            form = dict((k, v[0]) for k, v in parse_qs(body).items())
+        self._respond(*self.server.app.handle("POST", self.path, form))
+
+    def do_HEAD(self):
+        status, document = self.server.app.handle("HEAD", self.path, {})
+        self._respond(status, document, head=True)
+
+    def _respond(self, status, document, head=False):
+        etag = None
+        if isinstance(document, bytes):
+            body, content_type = document, "image/jpeg"
+        else:
+            body = json.dumps(document).encode("utf-8")
+            content_type = "application/json; charset=UTF-8"
+            if status == 200 and self.server.app.config.etags:
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if etag is not None and self.headers.get("if-none-match") == etag:
+            with self.server.app._lock:
+                self.server.app.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 512
+
+
+class MockGraphServer(object):
+    # Served for /{id}/picture
+    PICTURE = b"\xff\xd8\xff\xe0 not really a JPEG \xff\xd9"
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockGraphConfig()
+        self._server = _ThreadingHTTPServer((host, port), _Handler)
+        self._server.app = self
+        self._thread = None
+        self.requests = 0
+        self.connections = 0
+        self.not_modified = 0
+        self.log = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    def start(self):
+        # A short poll interval keeps stop() quick
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method, url, form):
+        """Returns the status and JSON document (or image) for a request."""
+        path, query = urlsplit(url)[2:4]
+        args = dict((k, v[0]) for k, v in parse_qs(query).items())
+        args.update(form)
+        with self._lock:
+            self.requests += 1
+            self.log.append((method, path, args))
+        config = self.config
+        if config.latency:
+            time.sleep(config.latency)
+        if method == "POST" and "batch" in args:
+            return 200, self._batch(json.loads(args["batch"]))
+        return self._resolve(path, args)
+
+    def _resolve(self, path, args):
+        config = self.config
+        if config.error_rate and config.random.random() < config.error_rate:
+            return 500, {"error": {"message": "Injected error",
+                                   "type": "OAuthException",
+                                   "code": config.error_code}}
+        segments = [segment for segment in path.split("/") if segment]
+        if segments:
+            ids = segments[:1]
+        else:
+            ids = [id for id in args.get("ids", "").split(",") if id]
+        for id in ids:
+            if id.startswith("missing"):
+                return 404, {"error": {"message": "Unknown object %s" % id,
+                                       "type": "OAuthException",
+                                       "code": 803}}
+        if not segments:
+            return 200, dict((id, self._object(id)) for id in ids)
+        if len(segments) == 1:
+            return 200, self._object(segments[0])
+        if segments[1] == "picture":
+            return 200, self.PICTURE
+        return 200, self._page(path, segments[0], int(args.get("after", 0)))
+
+    def _batch(self, requests):
+        responses = []
+        for request in requests:
+            relative_url = request["relative_url"]
+            path, query = (relative_url.split("?", 1) + [""])[:2]
+            args = dict((k, v[0]) for k, v in parse_qs(query).items())
+            status, document = self._resolve("/" + path, args)
+            responses.append({
+                "code": status,
+                "headers": [{"name": "Content-Type",
+                             "value": "application/json; charset=UTF-8"}],
+                "body": json.dumps(document)})
+        return responses
+
+    def _object(self, id):
+        return {"id": id, "name": "x" * self.config.item_size}
+
+    def _page(self, path, id, page):
+        config = self.config
+        start = page * config.page_size
+        document = {"data": [self._object("%s_%s" % (id, start + i))
+                             for i in range(config.page_size)],
+                    "paging": {"cursors": {"after": str(page + 1)}}}
+        if page + 1 < config.pages:
+            document["paging"]["next"] = "%s%s?after=%s" % (
+                self.url, path, page + 1)
+        return document
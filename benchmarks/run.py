@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Offline benchmarks for the Facebook Python SDK.
+
+Each benchmark runs in its own process against a local MockGraphServer,
+so no access token or network connection is needed, and reports its
+throughput, per-operation latency and peak memory use. Results are
+saved to benchmarks/results/<label>.json (the label defaults to the
+version in setup.py) so that releases can be compared:
+
+    python benchmarks/run.py
+    python benchmarks/run.py --label my-branch --compare 1.3.8-alpha
+    python benchmarks/run.py --only paging --latency 0.01
+
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import re
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; memory use is then not reported
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import facebook
+from mockgraph import MockGraphConfig, MockGraphServer
+
+RESULTS_DIR = os.path.join(HERE, "results")
+
+
+def bench_get_object(options):
+    server = _start(options)
+    graph = facebook.GraphAPI("token", base_url=server.url)
+    return _timed(lambda: graph.get_object("4"), options.iterations)
+
+
+def bench_get_object_with_retries(options):
+    server = _start(options, error_rate=0.2, error_code=2)
+    policy = facebook.RetryPolicy(retries=10, backoff=0.001)
+    graph = facebook.GraphAPI("token", base_url=server.url,
+                              retry_policy=policy)
+    return _timed(lambda: graph.get_object("4"), options.iterations)
+
+
+def bench_paging(options):
+    server = _start(options, pages=options.pages)
+    graph = facebook.GraphAPI("token", base_url=server.url)
+    result = _timed(lambda: graph.get_connections("4", "feed"),
+                    max(options.iterations // 10, 1))
+    result["items_per_op"] = options.pages * options.page_size
+    return result
+
+
+def bench_iter_connections(options):
+    server = _start(options, pages=options.pages)
+    graph = facebook.GraphAPI("token", base_url=server.url)
+
+    def _crawl():
+        for _ in graph.iter_connections("4", "feed"):
+            pass
+    result = _timed(_crawl, max(options.iterations // 10, 1))
+    result["items_per_op"] = options.pages * options.page_size
+    return result
+
+
+def bench_get_objects(options):
+    server = _start(options)
+    graph = facebook.GraphAPI("token", base_url=server.url)
+    ids = [str(i) for i in range(options.ids)]
+    result = _timed(lambda: graph.get_objects(ids),
+                    max(options.iterations // 10, 1))
+    result["ids_per_op"] = options.ids
+    return result
+
+
+def bench_execute(options):
+    server = _start(options)
+    graph = facebook.GraphAPI("token", base_url=server.url)
+
+    def _execute():
+        with graph:
+            for i in range(options.batch_size):
+                graph.get_object(str(i))
+        graph.execute()
+    result = _timed(_execute, max(options.iterations // 10, 1))
+    result["requests_per_op"] = options.batch_size
+    return result
+
+
+def bench_parse_signed_request(options):
+    signed_request = _signed_request("benchmark secret")
+    return _timed(lambda: facebook.parse_signed_request(signed_request,
+                                                        "benchmark secret"),
+                  options.iterations * 10)
+
+
+def bench_signed_request_verifier(options):
+    # The same cookie on every page view
+    verifier = facebook.SignedRequestVerifier("benchmark secret")
+    signed_request = _signed_request("benchmark secret")
+    return _timed(lambda: verifier.parse(signed_request),
+                  options.iterations * 10)
+
+
+def _signed_request(secret, user_id=4):
+    payload = base64.urlsafe_b64encode(json.dumps({
+        "algorithm": "HMAC-SHA256",
+        "code": "x" * 100,
+        "issued_at": int(time.time()),
+        "user_id": str(user_id)}).encode("ascii")).rstrip(b"=")
+    sig = base64.urlsafe_b64encode(hmac.new(
+        secret.encode("ascii"), payload, hashlib.sha256).digest()).rstrip(b"=")
+    return (sig + b"." + payload).decode("ascii")
+
+
+BENCHMARKS = [
+    ("get_object", bench_get_object),
+    ("get_object_with_retries", bench_get_object_with_retries),
+    ("paging", bench_paging),
+    ("iter_connections", bench_iter_connections),
+    ("get_objects", bench_get_objects),
+    ("execute", bench_execute),
+    ("parse_signed_request", bench_parse_signed_request),
+    ("signed_request_verifier", bench_signed_request_verifier),
+]
+
+
+def _start(options, **overrides):
+    settings = dict(latency=options.latency, page_size=options.page_size,
+                    item_size=options.item_size, seed=0)
+    settings.update(overrides)
+    return MockGraphServer(MockGraphConfig(**settings)).start()
+
+
+def _timed(operation, iterations):
+    """Runs operation and returns its throughput and latency."""
+    operation()  # Warm up connections and caches
+    latencies = []
+    started = time.time()
+    for _ in range(iterations):
+        op_started = time.time()
+        operation()
+        latencies.append(time.time() - op_started)
+    elapsed = time.time() - started
+    latencies.sort()
+    return {"iterations": iterations,
+            "seconds": elapsed,
+            "ops_per_second": iterations / elapsed,
+            "latency_p50": latencies[len(latencies) // 2],
+            "latency_p95": latencies[int(len(latencies) * 0.95)],
+            "latency_max": latencies[-1]}
+
+
+def _run_isolated(benchmark, options, results):
+    try:
+        result = benchmark(options)
+        if resource is not None:
+            # Kilobytes on Linux, bytes on OS X
+            result["max_rss"] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+        results.put(result)
+    except Exception as e:
+        results.put({"error": repr(e)})
+
+
+def run(names, options):
+    results = {}
+    for name, benchmark in BENCHMARKS:
+        if names and name not in names:
+            continue
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_isolated,
+                                          args=(benchmark, options, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+        print("%-25s %s" % (name, _summary(results[name])))
+    return results
+
+
+def _summary(result):
+    if "error" in result:
+        return "failed: %s" % result["error"]
+    return "%10.1f ops/s  p50 %8.2fms  p95 %8.2fms  rss %s" % (
+        result["ops_per_second"], result["latency_p50"] * 1000,
+        result["latency_p95"] * 1000, result.get("max_rss", "-"))
+
+
+def compare(results, baseline_label):
+    with open(os.path.join(RESULTS_DIR, baseline_label + ".json")) as f:
+        baseline = json.load(f)["results"]
+    print("\nChange since %s:" % baseline_label)
+    for name in sorted(results):
+        old, new = baseline.get(name), results[name]
+        if not old or "error" in old or "error" in new:
+            continue
+        print("%-25s throughput %+7.1f%%  p95 latency %+7.1f%%" % (
+            name,
+            100.0 * (new["ops_per_second"] / old["ops_per_second"] - 1),
+            100.0 * (new["latency_p95"] / old["latency_p95"] - 1)))
+
+
+def _default_label():
+    with open(os.path.join(os.path.dirname(HERE), "setup.py")) as f:
+        match = re.search(r'VERSION = "([^"]+)"', f.read())
+    return match and match.group(1) or "unknown"
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--label", default=_default_label(),
+                      help="name to save the results under")
+    parser.add_option("--compare", metavar="LABEL",
+                      help="compare with earlier results saved as LABEL")
+    parser.add_option("--only", action="append", default=[],
+                      help="run only this benchmark (may be repeated)")
+    parser.add_option("--no-save", action="store_true",
+                      help="don't save the results")
+    parser.add_option("--iterations", type="int", default=200)
+    parser.add_option("--latency", type="float", default=0,
+                      help="seconds the mock server adds to responses")
+    parser.add_option("--pages", type="int", default=20)
+    parser.add_option("--page-size", type="int", default=100)
+    parser.add_option("--item-size", type="int", default=200)
+    parser.add_option("--ids", type="int", default=500)
+    parser.add_option("--batch-size", type="int", default=200)
+    options, _ = parser.parse_args()
+
+    results = run(options.only, options)
+    if not options.no_save:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        settings = dict((k, v) for k, v in vars(options).items()
+                        if k not in ("label", "compare", "only", "no_save"))
+        with open(os.path.join(RESULTS_DIR, options.label + ".json"),
+                  "w") as f:
+            json.dump({"label": options.label,
+                       "python": platform.python_version(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "settings": settings,
+                       "results": results}, f, indent=2, sort_keys=True)
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == "__main__":
+    main()
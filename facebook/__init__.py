@@ -33,21 +33,63 @@ if user:
 
 """
 
-import copy
 import logging
 import urllib
 import hashlib
 import hmac
 import base64
+import collections
+import contextlib
+import copy
+import re
 import requests
 import json
+import mmap
+import os
+import random
+import threading
 import time
 
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
 # Find a query string parser
 try:
     from urllib.parse import parse_qs
+    import urllib.parse as urlparse
 except ImportError:
     from urlparse import parse_qs
+    import urlparse
+
+# Compare signatures in constant time
+try:
+    from hmac import compare_digest
+except ImportError:
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(bytearray(a), bytearray(b)):
+            result |= x ^ y
+        return result == 0
+
+# Streams multipart bodies, such as batch requests with attached files,
+# if installed
+try:
+    from requests_toolbelt import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
+
+# Find the fastest JSON decoder available
+try:
+    from orjson import loads as fast_json_loads
+except ImportError:
+    try:
+        from ujson import loads as fast_json_loads
+    except ImportError:
+        fast_json_loads = json.loads
 
 
 logger = logging.getLogger(__name__)
@@ -55,6 +97,26 @@ logger = logging.getLogger(__name__)
 
 BASE_URL = "https://graph.facebook.com"
 ERROR_CODE_TYPE_2 = 2
+# Number of keep-alive connections held open to the Graph API host
+DEFAULT_POOL_SIZE = 10
+# The Graph API rejects batch requests with more sub-requests than this
+BATCH_MAX_REQUESTS = 50
+DEFAULT_BATCH_WORKERS = 4
+# Most IDs the Graph API accepts in a single ids= request
+GET_OBJECTS_MAX_IDS = 50
+# Longer URLs are sent as POST requests with method=GET instead
+# https://developers.facebook.com/docs/graph-api/using-graph-api/v2.3#largerequests
+MAX_URL_LENGTH = 2000
+# Size of the chunks read from the connection by streaming downloads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Size of the video chunks uploaded when resuming an upload session
+VIDEO_CHUNK_SIZE = 4 * 1024 * 1024
+# Number of objects fan_out() fetches connections for at once
+DEFAULT_FAN_OUT_WORKERS = 8
+# Number of calls AsyncGraphAPI keeps in flight at once
+DEFAULT_CONCURRENCY = 20
+# Query string parameters that authenticate a request
+AUTH_ARGS = ("access_token", "appsecret_proof")
 
 
 class GraphAPI(object):
@@ -85,11 +147,40 @@ class GraphAPI(object):
     get_user_from_cookie() method below to get the OAuth access token
     for the active user from the cookie saved by the SDK.
 
+    Every request made by the client (including paging and batch
+    requests) goes through a single requests.Session, so connections
+    to the Graph API are pooled and kept alive between calls. Pass
+    your own session to share a pool between clients, and call
+    close() (or use contextlib.closing) to release the connections:
+
+       with contextlib.closing(facebook.GraphAPI(access_token)) as graph:
+           user = graph.get_object("me")
+
     """
-    def __init__(self, access_token=None, timeout=None, base_url=None, follow_paging=True, error_code_2_retries=0, error_code_2_sleeptime=0):
+    def __init__(self, access_token=None, timeout=None, base_url=None,
+                 follow_paging=True, error_code_2_retries=0,
+                 error_code_2_sleeptime=0, session=None,
+                 pool_size=DEFAULT_POOL_SIZE, keep_alive=True,
+                 preconnect=False, prefetch_pages=0,
+                 batch_workers=DEFAULT_BATCH_WORKERS, cache=None,
+                 single_flight=False, rate_limiter=None, retry_policy=None,
+                 json_loads=None, adaptive_paging=None, hooks=None,
+                 app_secret=None, token_manager=None, token_pool=None):
         self.access_token = access_token
         self.timeout = timeout
         self.base_url = base_url or BASE_URL
+        # Sessions passed in by the caller are shared, so we leave their
+        # configuration and lifecycle alone
+        self._owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            if not keep_alive:
+                session.headers['Connection'] = 'close'
+        self.session = session
         # Indicates whether you want your API requests to automatically do the
         # serial paging calls for you and return the aggregate results
         self.follow_paging = follow_paging
@@ -98,11 +189,196 @@ class GraphAPI(object):
         # via https://developers.facebook.com/docs/graph-api/using-graph-api/
         self.error_code_2_retries = error_code_2_retries
         self.error_code_2_sleeptime = error_code_2_sleeptime
+        # Decides which failed requests (including paged and batch
+        # requests) are retried and how long to wait in between. The
+        # error_code_2_* settings are only consulted when no policy is
+        # given.
+        if retry_policy is None:
+            retry_policy = RetryPolicy(retries=error_code_2_retries,
+                                       backoff=error_code_2_sleeptime,
+                                       exponential=False,
+                                       jitter=False,
+                                       error_codes=[ERROR_CODE_TYPE_2],
+                                       statuses=[],
+                                       connection_errors=False)
+        self.retry_policy = retry_policy
+        # Decodes JSON responses; pass fast_json_loads to use orjson or
+        # ujson where installed
+        self.json_loads = json_loads or json.loads
+        # Optional factory for the PageSizeTuner used by each paged
+        # request, e.g. PageSizeTuner itself or a functools.partial of it
+        self.adaptive_paging = adaptive_paging
+        # Callables told about every request; see add_hook()
+        self.hooks = list(hooks or [])
+        self._instrumented = threading.local()
+        # How many pages iter_pages()/iter_connections() fetch ahead in the
+        # background by default (0 fetches each page on demand)
+        self.prefetch_pages = prefetch_pages
+        # Number of batch chunks execute() sends at the same time
+        self.batch_workers = batch_workers
+        # Optional GraphCache consulted for GET requests
+        self.cache = cache
+        # When set, concurrent identical GET requests made through this
+        # client are coalesced into one, and each caller gets a copy of
+        # its result
+        self.single_flight = single_flight
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        # Rate limit utilization reported by the Graph API's usage headers
+        self.usage = GraphUsage()
+        # Optional RateLimiter that paces requests based on self.usage
+        self.rate_limiter = rate_limiter
+        # Optional AppTokenManager supplying the app access token when
+        # no access_token is given, and the appsecret_proof sent along
+        # with whichever token is used
+        if token_manager is None and app_secret:
+            token_manager = AppTokenManager(None, app_secret)
+        self.token_manager = token_manager
+        # Optional TokenPool that requests draw their token from when
+        # no access_token is given
+        self.token_pool = token_pool
+        self._pool_local = threading.local()
         self._batch_request = False
+        if preconnect:
+            self.warm_up()
+
+    def warm_up(self):
+        """Opens a connection to the Graph API ahead of the first request.
+
+        This moves the TCP and TLS handshakes out of the latency of the
+        first real call. Failures are logged and otherwise ignored; the
+        connection will simply be established on demand instead.
+
+        """
+        logger.debug("Warming up connection to %s", self.base_url)
+        try:
+            self.session.head(self.base_url, timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.warning("Could not warm up connection to %s: %s",
+                           self.base_url, e)
+
+    def close(self):
+        """Releases the pooled connections held by this client.
+
+        Sessions passed in by the caller are left open.
+        """
+        if self._owns_session:
+            self.session.close()
+
+    def _send(self, method, url, **kwargs):
+        """Sends an HTTP request over the pooled session.
+
+        Waits for the rate limiter first, if there is one, and records
+        the usage headers of the response.
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.usage)
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.request(method, url, **kwargs)
+        self.usage.update(response.headers)
+        pooled_token = getattr(self._pool_local, 'token', None)
+        if pooled_token is not None:
+            self.token_pool.update(pooled_token, response.headers)
+        calls = getattr(self._instrumented, 'calls', None)
+        if calls:
+            if kwargs.get('stream'):
+                bytes_in = int(response.headers.get('content-length') or 0)
+            else:
+                bytes_in = len(response.content)
+            try:
+                bytes_out = len(response.request.body or '')
+            except TypeError:
+                bytes_out = 0
+            for stats in calls:
+                stats.attempts += 1
+                stats.status = response.status_code
+                stats.bytes_in += bytes_in
+                stats.bytes_out += bytes_out
+        return response
+
+    def add_hook(self, hook):
+        """Adds a callable to be called with an event dict per request.
+
+        Events are reported for every request made with request(),
+        every page fetched while following paging and every batch
+        request. Each event has these keys:
+
+            kind: "request", "page" or "batch"
+            endpoint: the path, with numeric IDs replaced by {id}
+            method, status, latency (in seconds), bytes_in, bytes_out
+            error_code: the Graph API error code, if the call failed
+            error: the exception, if the call failed
+            retries: the number of retried HTTP requests
+            pages: the number of pages fetched
+            batch_size: the number of requests in a batch
+
+        Events for a request() that follows paging include its pages,
+        which are also reported separately. Hooks are called on the
+        thread that made the request; exceptions they raise are logged
+        and ignored. See GraphMetrics for a ready-made hook.
+
+        """
+        self.hooks.append(hook)
+
+    @contextlib.contextmanager
+    def _measure(self):
+        """Adds up the HTTP requests made in its block."""
+        stats = _CallStats()
+        calls = getattr(self._instrumented, 'calls', None)
+        if calls is None:
+            calls = self._instrumented.calls = []
+        calls.append(stats)
+        try:
+            yield stats
+        finally:
+            calls.remove(stats)
+
+    @contextlib.contextmanager
+    def _instrument(self, kind, method, path, batch_size=None):
+        """Measures the HTTP requests made in its block for the hooks."""
+        stats = _CallStats()
+        if not self.hooks:
+            yield stats
+            return
+        calls = getattr(self._instrumented, 'calls', None)
+        if calls is None:
+            calls = self._instrumented.calls = []
+        calls.append(stats)
+        error = None
+        started = time.time()
+        try:
+            yield stats
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            calls.remove(stats)
+            status = stats.status
+            if status is None and isinstance(error, GraphAPIError):
+                status = error.status_code
+            event = {"kind": kind,
+                     "endpoint": _endpoint_template(path),
+                     "method": method,
+                     "status": status,
+                     "latency": time.time() - started,
+                     "bytes_in": stats.bytes_in,
+                     "bytes_out": stats.bytes_out,
+                     "error_code": getattr(error, 'type', None) or None,
+                     "error": error,
+                     "retries": max(stats.attempts - stats.pages, 0),
+                     "pages": stats.pages,
+                     "batch_size": batch_size}
+            for hook in list(self.hooks):
+                try:
+                    hook(event)
+                except Exception:
+                    logger.exception("Exception in request hook %r", hook)
 
     def __enter__(self):
         self._batch_request = True
         self._requests_stack = []
+        # Files attached to requests in the stack, by attachment name
+        self._batch_files = {}
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -117,14 +393,106 @@ class GraphAPI(object):
 
         We return a map from ID to object. If any of the IDs are
         invalid, we raise an exception.
+
+        The Graph API limits how many IDs one request may ask for, so
+        the IDs are fetched in chunks of GET_OBJECTS_MAX_IDS, up to
+        batch_workers chunks at a time. Chunks whose URL would exceed
+        MAX_URL_LENGTH are sent as a POST with method=GET. If any chunk
+        fails, the first error is raised with the objects that were
+        fetched in its `data` attribute and a list of (ids, error)
+        pairs for the failed chunks in its `errors` attribute.
         """
+        ids = list(ids)
+        if self._batch_request:
+            args["ids"] = ",".join(ids)
+            return self.request("", args)
+
+        chunks = [ids[i:i + GET_OBJECTS_MAX_IDS]
+                  for i in xrange(0, len(ids), GET_OBJECTS_MAX_IDS)]
+        objects = {}
+        errors = []
+        for index, chunk, result, error in _imap_unordered(
+                lambda chunk: self._get_objects_chunk(chunk, args),
+                chunks, self.batch_workers):
+            if error is not None:
+                errors.append((index, chunk, error))
+            else:
+                objects.update(result)
+        if errors:
+            errors.sort(key=lambda failure: failure[0])
+            error = errors[0][2]
+            if not isinstance(error, GraphAPIError):
+                raise error
+            error.data = objects
+            error.errors = [(chunk, e) for _, chunk, e in errors]
+            raise error
+        return objects
+
+    def _get_objects_chunk(self, ids, args):
+        args = dict(args)
         args["ids"] = ",".join(ids)
-        return self.request("", args)
+        url_length = len(self.base_url) + 2 + len(_urlencode(args))
+        auth_args = self._auth_args(acquire=False)
+        if auth_args:
+            url_length += len(_urlencode(auth_args)) + 1
+        if url_length > MAX_URL_LENGTH:
+            args["method"] = "GET"
+            return self.request("", post_args=args, method="POST",
+                                follow_paging=False)
+        return self.request("", args, follow_paging=False)
+
+    def query(self, path):
+        """Starts building a request for exactly the fields you need.
+
+        For example, this fetches the ten latest posts of the active
+        user with the author and text of their first five comments, in
+        a single request:
+
+            posts = graph.query("me/feed").fields(
+                "message",
+                facebook.Field("comments", "from", "message", limit=5),
+            ).limit(10).get()
+
+        """
+        return GraphQuery(self, path)
 
     def get_connections(self, id, connection_name, **args):
         """Fetchs the connections for given object."""
         return self.request(id + "/" + connection_name, args)
 
+    def fan_out(self, ids, connection_name,
+                max_workers=DEFAULT_FAN_OUT_WORKERS, follow_paging=True,
+                **args):
+        """Fetchs the given connection for each of many objects.
+
+        Requests run on up to max_workers threads, each following the
+        paging of its connection. We yield (id, result) pairs as the
+        requests complete, in no particular order. If the request for
+        an ID fails, its result is the exception, and the other IDs
+        carry on:
+
+            for id, feed in graph.fan_out(page_ids, "feed", limit=100):
+                if isinstance(feed, facebook.GraphAPIError):
+                    log_failure(id, feed)
+                else:
+                    store(id, feed["data"])
+
+        ids may be any iterable, and is consumed as workers free up.
+        The client's pool_size should be at least max_workers.
+
+        """
+        def _get_connections(id):
+            return self.request(id + "/" + connection_name, dict(args),
+                                follow_paging=follow_paging)
+
+        for _, id, result, error in _imap_unordered(_get_connections, ids,
+                                                    max_workers):
+            if error is not None:
+                logger.warning("Fetching %s/%s failed: %s",
+                               id, connection_name, error)
+                result = error
+            yield id, result
+
     def post_object(self, id, **args):
         """Fetchs the given object from the graph, using POST.
         https://developers.facebook.com/docs/graph-api/using-graph-api/v2.3#largerequests
@@ -174,7 +542,8 @@ class GraphAPI(object):
         about publishing permissions.
 
         """
-        assert self.access_token, "Write operations require an access token"
+        assert self._has_access_token(), \
+            "Write operations require an access token"
         return self.request(parent_object + "/" + connection_name,
                             post_args=data,
                             method="POST")
@@ -230,26 +599,256 @@ class GraphAPI(object):
                      files={"file": image},
                      method="POST")
 
-    def _handle_response(self, status_code, headers, body, url=None):
-        result = None
+    def put_video(self, video, target="me", chunk_size=None, max_workers=1,
+                  chunk_retries=3, upload_session_id=None, start_offset=0,
+                  **kwargs):
+        """Uploads a video using a resumable upload session.
+
+        video=Filename or file like object for the video
+        target=ID of the user, page or group to post the video to
+        kwargs=Additional fields for the video, such as title or
+        description
+
+        The video is sent in chunks, each of which is retried up to
+        chunk_retries times (instead of following the client's retry
+        policy). Files on disk are read through a memory
+        map rather than loaded whole. By default chunks are sent one
+        after another at the offsets the API asks for; with max_workers
+        greater than one, chunks of chunk_size bytes (or the size the
+        API suggests) are sent concurrently instead.
+
+        If sending the chunks fails, the exception raised carries the
+        session's upload_session_id, video_id and the start_offset up
+        to which the video was received. Pass upload_session_id and
+        start_offset to resume it.
+
+        """
+        if self._batch_request:
+            raise GraphAPIError("Videos cannot be uploaded in batch requests")
+        path = target + "/videos"
+        url = self.base_url + "/" + path
+        retry_policy = RetryPolicy(retries=chunk_retries)
+        reader = _ChunkReader(video)
+        video_id = None
         try:
-            # Attempt to retrieve JSON by default
-            result = json.loads(body)
-        except ValueError:
-            if 'image/' in headers.get('content-type', ''):
-                mimetype = headers['content-type']
-                result = {"data": body,
-                          "mime-type": mimetype,
-                          "url": url}
-            elif "access_token" in parse_qs(body):
-                query_str = parse_qs(body)
-                if "access_token" in query_str:
-                    result = {"access_token": query_str["access_token"][0]}
-                    if "expires" in query_str:
-                        result["expires"] = query_str["expires"][0]
-                else:
-                    raise GraphAPIError(json.loads(body), status_code)
+            if upload_session_id is None:
+                started = self.request(path,
+                                       post_args={"upload_phase": "start",
+                                                  "file_size": reader.size},
+                                       method="POST", follow_paging=False)
+                upload_session_id = started["upload_session_id"]
+                video_id = started.get("video_id")
+                start_offset = int(started["start_offset"])
+                end_offset = int(started["end_offset"])
+                if chunk_size:
+                    end_offset = min(start_offset + chunk_size, end_offset)
             else:
+                end_offset = min(
+                    start_offset + (chunk_size or VIDEO_CHUNK_SIZE),
+                    reader.size)
+
+            def _transfer(offsets):
+                start, end = offsets
+                logger.debug("Uploading video chunk %s-%s of %s",
+                             start, end, reader.size)
+                post_args = {"upload_phase": "transfer",
+                             "upload_session_id": upload_session_id,
+                             "start_offset": start}
+                post_args.update(self._auth_args())
+                files = {"video_file_chunk": ("chunk",
+                                              reader.read(start, end))}
+                # Sent without going through self.request(), so that the
+                # client's retries don't multiply the chunk's. A chunk is
+                # sent at a fixed offset, so sending it again is safe.
+                with self._instrument("request", "POST", url):
+                    return retry_policy.call(
+                        self._with_token_pool, post_args, self._fetch,
+                        "POST", url, None, post_args, files)
+
+            try:
+                if max_workers > 1:
+                    # The API's suggested size is zero when resuming
+                    # at the end of the video
+                    size = (chunk_size or (end_offset - start_offset) or
+                            VIDEO_CHUNK_SIZE)
+                    chunks = [(offset, min(offset + size, reader.size))
+                              for offset in xrange(start_offset, reader.size,
+                                                   size)]
+                    failures = [(offsets[0], error) for _, offsets, _, error
+                                in _imap_unordered(_transfer, chunks,
+                                                   max_workers)
+                                if error is not None]
+                    if failures:
+                        start_offset, error = min(failures,
+                                                  key=lambda f: f[0])
+                        raise error
+                else:
+                    while start_offset < end_offset:
+                        transferred = _transfer((start_offset, end_offset))
+                        start_offset = int(transferred["start_offset"])
+                        end_offset = int(transferred["end_offset"])
+                        if chunk_size:
+                            end_offset = min(start_offset + chunk_size,
+                                             end_offset)
+            except Exception as e:
+                # Connection errors and timeouts too, so that any failed
+                # upload can be resumed
+                e.upload_session_id = upload_session_id
+                e.video_id = video_id
+                e.start_offset = start_offset
+                raise e
+        finally:
+            reader.close()
+
+        kwargs.update({"upload_phase": "finish",
+                       "upload_session_id": upload_session_id})
+        result = self.request(path, post_args=kwargs, method="POST",
+                              follow_paging=False)
+        if video_id and isinstance(result, dict):
+            result.setdefault("video_id", video_id)
+        return result
+
+    def iter_download(self, path, chunk_size=DOWNLOAD_CHUNK_SIZE, **args):
+        """Streams a binary response (an image or video) in chunks.
+
+        Chunks are read from the connection as they are consumed, so
+        memory use is bounded by chunk_size however large the file is.
+        path may be a Graph API path such as "me/picture" or an absolute
+        URL, such as the "source" of a video; the access token is only
+        sent to the Graph API.
+
+        """
+        response = self.retry_policy.call(self._open_download, path, args)
+        try:
+            for chunk in response.iter_content(chunk_size):
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
+
+    def download(self, path, destination, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 **args):
+        """Streams a binary response into a file.
+
+        destination is a filename or a file-like object open for
+        writing in binary mode. We return a dict with the "mime-type"
+        and final "url" of the download, and its "size" in bytes.
+
+        """
+        response = self.retry_policy.call(self._open_download, path, args)
+        owns_file = not hasattr(destination, 'write')
+        if owns_file:
+            destination = open(destination, 'wb')
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size):
+                destination.write(chunk)
+                size += len(chunk)
+        finally:
+            response.close()
+            if owns_file:
+                destination.close()
+        return {"mime-type": response.headers.get('content-type'),
+                "url": response.url,
+                "size": size}
+
+    def _open_download(self, path, args):
+        if path.startswith(('http://', 'https://')):
+            url = path
+        else:
+            url = self.base_url + '/' + path
+            args = dict(args, **self._auth_args())
+        logger.debug("Download from %s", url)
+        response = self._send("GET", url, params=args, stream=True)
+        content_type = response.headers.get('content-type', '')
+        if (response.status_code >= 400 or 'json' in content_type or
+                'javascript' in content_type):
+            # Errors are small JSON documents, so it is fine to read them
+            try:
+                result = self._decode(response)
+            finally:
+                response.close()
+            raise GraphAPIError("Expected a binary response but got %s: %s"
+                                % (content_type, result),
+                                response.status_code)
+        return response
+
+    def _fetch(self, method, url, params=None, data=None, files=None):
+        """Sends a single request and decodes its response.
+
+        GET requests are answered from the cache, if there is one and
+        it holds a fresh entry. Stale entries with an ETag are
+        revalidated with If-None-Match instead of being re-downloaded.
+
+        """
+        cache = self.cache
+        if cache is None or method != "GET":
+            response = self._send(method, url, params=params, data=data,
+                                  files=files)
+            return self._decode(response)
+
+        key = cache.key(*self._unpooled(url, params))
+        entry = cache.get(key)
+        headers = {}
+        if entry is not None:
+            if entry.is_fresh():
+                logger.debug("Cache hit for %s", url)
+                if entry.error is not None:
+                    # Callers annotate the errors they catch, so each
+                    # gets its own copy
+                    raise _copy_error(entry.error)
+                return entry.result
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+        response = self._send(method, url, params=params, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            logger.debug("Cached response for %s is still valid", url)
+            cache.set(key, entry.result, etag=entry.etag)
+            return entry.result
+        try:
+            result = self._decode(response)
+        except GraphAPIError as e:
+            if cache.is_cacheable_error(e):
+                cache.set(key, error=_copy_error(e))
+            raise e
+        cache.set(key, result, etag=response.headers.get('etag'))
+        return result
+
+    def _decode(self, response):
+        try:
+            return self._handle_response(response.status_code,
+                                         response.headers,
+                                         response.content,
+                                         response.url)
+        except GraphAPIError as e:
+            e.headers = response.headers
+            raise e
+
+    def _handle_response(self, status_code, headers, body, url=None):
+        result = None
+        content_type = headers.get('content-type', '')
+        if 'json' in content_type or 'javascript' in content_type:
+            try:
+                result = self.json_loads(body)
+            except ValueError:
+                raise GraphAPIError('Body was not valid JSON', status_code)
+        elif 'image/' in content_type:
+            result = {"data": body,
+                      "mime-type": content_type,
+                      "url": url}
+        else:
+            # Older OAuth responses are querystrings sent as text/plain;
+            # for anything else we have to go by the body itself
+            parsed = content_type.startswith('text/plain')
+            if parsed:
+                result = self._parse_querystring(body)
+            if result is None:
+                try:
+                    result = self.json_loads(body)
+                except ValueError:
+                    if not parsed:
+                        result = self._parse_querystring(body)
+            if result is None:
                 raise GraphAPIError('Body was not JSON, image, or querystring',
                                     status_code)
         if status_code >= 400:
@@ -261,149 +860,430 @@ class GraphAPI(object):
             raise GraphAPIError(result, status_code)
         return result
 
+    def _parse_querystring(self, body):
+        """Parses the querystring format used by older OAuth responses.
+
+        Returns None if the body does not hold an access token.
+        """
+        query_str = parse_qs(body)
+        if "access_token" not in query_str:
+            return None
+        result = {"access_token": query_str["access_token"][0]}
+        if "expires" in query_str:
+            result["expires"] = query_str["expires"][0]
+        return result
+
     def request(
-            self, path, args=None, post_args=None, files=None, method=None):
+            self, path, args=None, post_args=None, files=None, method=None,
+            follow_paging=None):
         """Fetches the given path in the Graph API.
 
         We translate args to a valid query string. If post_args is
         given, we send a POST request to the given path with the given
-        arguments.
+        arguments. follow_paging overrides the client's setting for
+        this request only.
 
         """
-        args = args or {}
+        args = _render_fields(args or {})
 
-        if self.access_token:
+        auth_args = self._auth_args()
+        if auth_args:
             if post_args is not None:
-                post_args["access_token"] = self.access_token
+                post_args.update(auth_args)
             else:
-                args["access_token"] = self.access_token
+                args.update(auth_args)
         method = method or "GET"
 
         if self._batch_request:
-            # TODO: Support for binary data
-            # https://developers.facebook.com/docs/graph-api/making-multiple-requests/#binary
-            request = {'method': method}
-            if method in ("POST", "PUT") and post_args:
-                request['body'] = urllib.urlencode(post_args)
-            if args:
-                path += ('?' in path and '&' or '?')
-                path += urllib.urlencode(args)
-            logger.debug("Adding request (%s) to batch stack: %s", method, path)
-            request['relative_url'] = path
-            self._requests_stack.append(request)
+            self._requests_stack.append(
+                self._batch_entry(method, path, args, post_args, files))
             return
 
         url = self.base_url + '/' + path
+        if follow_paging is None:
+            follow_paging = self.follow_paging
+
+        if not self.single_flight or method != "GET":
+            return self._request(method, url, args, post_args, files,
+                                 follow_paging)
+
+        # Identical GETs already in flight on another thread share the
+        # outcome of that request instead of making their own
+        key_url, key_args = self._unpooled(url, args)
+        key = (key_url, _urlencode(sorted(key_args.items())), follow_paging)
+        with self._in_flight_lock:
+            entry = self._in_flight.get(key)
+            leader = entry is None
+            if leader:
+                # The outcome and the number of threads waiting on it
+                entry = self._in_flight[key] = [GraphFuture(), 0]
+            else:
+                entry[1] += 1
+        future = entry[0]
+        if not leader:
+            logger.debug("Waiting for in-flight request (%s) to %s",
+                         method, url)
+            # Each waiter gets its own copy, so that one caller changing
+            # the result or annotating the error isn't seen by the others
+            try:
+                return copy.deepcopy(future.result())
+            except GraphAPIError as e:
+                raise _copy_error(e, paging=True)
+        # Waiters must not be left blocked, even when the request is
+        # interrupted by something other than an Exception
+        result = None
+        error = GraphAPIError("The in-flight request was interrupted")
+        try:
+            result = self._request(method, url, args, post_args, files,
+                                   follow_paging)
+            error = None
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+                waiters = entry[1]
+            # The leader's caller is free to change what it gets back, so
+            # waiters copy from a snapshot taken before it returns
+            if error is None:
+                if waiters:
+                    future.set_result(copy.deepcopy(result))
+                else:
+                    future.set_result(result)
+            else:
+                if isinstance(error, GraphAPIError):
+                    error = _copy_error(error, paging=True)
+                future.set_exception(error)
+        return result
 
-        def _do_request_response():
-            logger.debug("Request (%s) to %s", method, url)
-            response = requests.request(method,
-                                        url,
-                                        timeout=self.timeout,
-                                        params=args,
-                                        data=post_args,
-                                        files=files)
-            return self._handle_response(response.status_code,
-                                         response.headers,
-                                         response.content,
-                                         response.url)
+    def _auth_args(self, acquire=True):
+        """Returns the access token and appsecret_proof to send.
+
+        With acquire=False, the token the next request would most
+        likely send is returned without taking it from the pool or
+        fetching the app access token, e.g. to estimate lengths.
+        """
+        access_token = self.access_token
+        if not access_token and self.token_pool is not None:
+            if acquire:
+                access_token = self.token_pool.acquire()
+            else:
+                access_token = self.token_pool.peek()
+        manager = self.token_manager
+        if manager is None:
+            return access_token and {"access_token": access_token} or {}
+        if not access_token and manager.app_id:
+            if acquire:
+                access_token = manager.get_app_access_token()
+            else:
+                # App access tokens take the form app_id|hash
+                access_token = manager._token or "%s|%s" % (
+                    manager.app_id, manager.app_secret)
+        if not access_token:
+            return {}
+        return {"access_token": access_token,
+                "appsecret_proof": manager.appsecret_proof(access_token)}
+
+    def _has_access_token(self):
+        """Returns whether requests will carry an access token, without
+        taking one from the pool or fetching the app access token.
+        """
+        manager = self.token_manager
+        return bool(self.access_token or
+                    (self.token_pool is not None and len(self.token_pool)) or
+                    (manager is not None and manager.app_id))
 
-        def _do_request_response_with_retries():
+    def _unpooled(self, url, args):
+        """Returns url and args without a pooled access token.
+
+        Requests differing only in which token of the pool they carry
+        are the same request to the cache and to single_flight.
+        """
+        if self.token_pool is None or self.access_token:
+            return url, args
+        if "access_token=" in url:
+            url = _update_url_query(url, access_token=None,
+                                    appsecret_proof=None)
+        args = dict((k, v) for k, v in (args or {}).items()
+                    if k not in AUTH_ARGS)
+        return url, args
+
+    def _with_token_pool(self, auth_args, fn, *args):
+        """Calls fn, which sends the access token in auth_args.
+
+        With a token pool, requests failing because of their token are
+        retried right away with other tokens from the pool, up to one
+        attempt per token.
+        """
+        if self.token_pool is None or self.access_token:
+            return fn(*args)
+        attempts = len(self.token_pool)
+        while True:
+            token = auth_args.get("access_token")
+            self._pool_local.token = token
             try:
-                return _do_request_response()
+                return fn(*args)
             except GraphAPIError as e:
-                logger.warning("Caught GraphAPIError %s (type=%s)", e, e.type)
-                if e.type != ERROR_CODE_TYPE_2 or not self.error_code_2_retries:
+                attempts -= 1
+                if (not self.token_pool.report_error(token, e) or
+                        attempts <= 0):
                     raise e
-            logger.warning("Request resulted in error code 2, trying again %s time%s",
-                           self.error_code_2_retries,
-                           self.error_code_2_retries != 1 and 's' or '',
-                           extra={'method': method, 'url': url})
-            for attempt in xrange(1, self.error_code_2_retries + 1):
-                logger.debug("Attempt %s (of %s)",
-                                     attempt,
-                                     self.error_code_2_retries)
-                if self.error_code_2_sleeptime:
-                    logger.debug("Sleeping for %s seconds before retrying after error code 2",
-                                 self.error_code_2_sleeptime)
-                    time.sleep(self.error_code_2_sleeptime)
-                try:
-                    return _do_request_response()
-                except GraphAPIError as e:
-                    if e.type != ERROR_CODE_TYPE_2 or attempt == self.error_code_2_retries:
-                        raise e
-
-        result = _do_request_response_with_retries()
-        data = result.get('data') or []
-        if self.follow_paging:
+                logger.info("Retrying with another token after: %s", e)
+                auth_args.update(self._auth_args())
+            finally:
+                self._pool_local.token = None
+
+    def _batch_entry(self, method, path, args=None, post_args=None,
+                     files=None):
+        """Describes a request as an entry of a batch request.
+
+        Files are attached to the batch request under names unique to
+        it and referred to from the entry.
+        https://developers.facebook.com/docs/graph-api/making-multiple-requests/#binary
+        """
+        request = {'method': method}
+        if method in ("POST", "PUT") and post_args:
+            request['body'] = urllib.urlencode(post_args)
+        if files:
+            names = []
+            for fileobj in files.values():
+                name = "file%s" % len(self._batch_files)
+                position = hasattr(fileobj, 'tell') and fileobj.tell() or 0
+                self._batch_files[name] = (fileobj, position)
+                names.append(name)
+            request['attached_files'] = ",".join(names)
+        if args:
+            path += ('?' in path and '&' or '?')
+            path += urllib.urlencode(args)
+        logger.debug("Adding request (%s) to batch stack: %s", method, path)
+        request['relative_url'] = path
+        return request
+
+    def _request(self, method, url, args, post_args, files, follow_paging):
+        """Sends a request, following its paging if asked to."""
+        with self._instrument("request", method, url) as stats:
+            result = self._request_pages(method, url, args, post_args, files,
+                                         follow_paging)
+            if isinstance(result, dict):
+                stats.pages = result.get('pages_seen', 1)
+            return result
+
+    def _request_pages(self, method, url, args, post_args, files,
+                       follow_paging):
+        def _do_request_response():
+            logger.debug("Request (%s) to %s", method, url)
+            return self._fetch(method,
+                               url,
+                               params=args,
+                               data=post_args,
+                               files=files)
+
+        auth_args = post_args if post_args is not None else args
+        # get_objects() sends long GETs as a POST with method=GET
+        retry_method = (post_args or {}).get('method') or method
+        result = self.retry_policy.call_method(
+            retry_method, self._with_token_pool, auth_args,
+            _do_request_response)
+        if follow_paging and isinstance(result, dict):
+            # Copy rather than modify the first page, which may be shared
+            # through the cache
+            result = dict(result)
             pages_seen = 1
-            next_result = copy.deepcopy(result)
             # If we do follow paging, don't return the paging data as part of
             # the result
-            if 'paging' in result:
-                del result['paging']
-            while True:
-                next_url = (next_result.get('paging') or {}).get('next')
-                if not next_url:
-                    break
-                def _do_paged_request_response():
-                    logger.debug("Paged request (%s) to %s", method, next_url)
-                    response = requests.request(method,
-                                                next_url,
-                                                timeout=self.timeout)
-                    return self._handle_response(response.status_code,
-                                                 response.headers,
-                                                 response.content,
-                                                 response.url)
-
-                def _do_paged_request_response_with_retries():
-                    try:
-                        return _do_paged_request_response()
-                    except GraphAPIError as e:
-                        logger.warning("Caught GraphAPIError %s (type=%s)", e, e.type)
-                        if e.type != ERROR_CODE_TYPE_2 or not self.error_code_2_retries:
-                            raise e
-                    logger.warning("Paged request resulted in error code 2, trying again %s time%s",
-                                   self.error_code_2_retries,
-                                   self.error_code_2_retries != 1 and 's' or '',
-                                   extra={'method': method, 'url': next_url})
-                    for attempt in xrange(1, self.error_code_2_retries + 1):
-                        logger.debug("Attempt %s (of %s)",
-                                     attempt,
-                                     self.error_code_2_retries)
-                        if self.error_code_2_sleeptime:
-                            logger.debug("Sleeping for %s seconds before retrying after error code 2",
-                                         self.error_code_2_sleeptime)
-                            time.sleep(self.error_code_2_sleeptime)
-                        try:
-                            return _do_paged_request_response()
-                        except GraphAPIError as e:
-                            if e.type != ERROR_CODE_TYPE_2 or attempt == self.error_code_2_retries:
-                                raise e
+            next_url = (result.pop('paging', None) or {}).get('next')
+            data = result.get('data')
+            if data is not None and not isinstance(data, list):
+                # Not a list of items (e.g. the bytes of an image), so there
+                # is nothing to aggregate
+                next_url = None
+            else:
+                data = list(data or [])
+            tuner = self._page_size_tuner()
+            while next_url:
                 try:
-                    next_result = _do_paged_request_response_with_retries()
+                    next_result = self._get_next_page(method, next_url, tuner)
                 except GraphAPIError as e:
                     e.data = data
                     e.pages_seen = pages_seen
+                    # The page that failed, to resume from with iter_pages()
+                    e.next_url = next_url
                     raise e
                 data += (next_result.get('data') or [])
                 pages_seen += 1
+                next_url = (next_result.get('paging') or {}).get('next')
             if data:
                 result.update({'data': data})
             result['pages_seen'] = pages_seen
         return result
 
+    def _get_next_page(self, method, next_url, tuner=None):
+        """Fetches the page at a `paging.next` URL returned by the API.
+
+        With a PageSizeTuner, the page's limit is set by the tuner, and
+        pages that fail for being too large are fetched again with a
+        smaller limit.
+        """
+        with self._instrument("page", method, next_url):
+            return self._get_tuned_page(method, next_url, tuner)
+
+    def _get_tuned_page(self, method, next_url, tuner):
+        def _do_paged_request_response(url):
+            logger.debug("Paged request (%s) to %s", method, url)
+            return self._fetch(method, url)
+
+        if tuner is None:
+            return self.retry_policy.call_method(
+                method, _do_paged_request_response, next_url)
+
+        def _do_sized_request_response(url):
+            try:
+                return _do_paged_request_response(url)
+            except (GraphAPIError, requests.Timeout) as e:
+                # Sending the same page again is pointless; get it past
+                # the retry policy so that it is shrunk straight away
+                if tuner.is_too_large(e) and tuner.can_shrink():
+                    raise _PageTooLarge(e)
+                raise e
+
+        while True:
+            url = tuner.apply(next_url)
+            started = time.time()
+            try:
+                with self._measure() as stats:
+                    page = self.retry_policy.call_method(
+                        method, _do_sized_request_response, url)
+            except _PageTooLarge as e:
+                tuner.shrink()
+                logger.warning("Page too large (%s), retrying with "
+                               "limit=%s", e.error, tuner.limit)
+                continue
+            # Pages served from the cache have no size
+            tuner.record(len(page.get('data') or []), time.time() - started,
+                         stats.bytes_in or None)
+            return page
+
+    def _page_size_tuner(self):
+        if self.adaptive_paging:
+            return self.adaptive_paging()
+        return None
+
+    def iter_pages(self, path, args=None, method=None, prefetch=None,
+                   state=None, checkpoint=None, checkpoint_every=1):
+        """Iterates over the pages of a paged response as they arrive.
+
+        Unlike request() with follow_paging, pages are not accumulated,
+        so memory use stays flat however long the connection is. The
+        returned GraphPager exposes the paging cursor of the last page
+        it yielded.
+
+        If prefetch is non-zero, up to that many pages are fetched on a
+        background thread while the caller works on the current one.
+        It defaults to the client's prefetch_pages setting.
+
+        Pass the state() of an earlier pager to resume it, or a
+        checkpoint filename to save progress every checkpoint_every
+        pages and resume from that file. See GraphPager.
+
+        """
+        if prefetch is None:
+            prefetch = self.prefetch_pages
+        return GraphPager(self, path, args, method, prefetch=prefetch,
+                          state=state, checkpoint=checkpoint,
+                          checkpoint_every=checkpoint_every)
+
+    def iter_connections(self, id, connection_name, **args):
+        """Iterates over the connections for given object, one by one."""
+        return GraphPager(self, id + "/" + connection_name, args, items=True,
+                          prefetch=self.prefetch_pages)
+
     def execute(self):
-        post_args = {'batch': json.dumps(self._requests_stack)}
-        if self.access_token:
-            post_args['access_token'] = self.access_token
+        """Sends the requests collected in batch mode to the Graph API.
+
+        The Graph API accepts at most BATCH_MAX_REQUESTS requests per
+        batch, so larger stacks are split into chunks which are sent
+        concurrently over up to batch_workers connections. Results are
+        returned in the order the requests were made; a failed request
+        is represented by its GraphAPIError. If a whole chunk fails,
+        its error takes the place of each of its requests, unless every
+        chunk failed, in which case the error is raised.
+
+        """
+        requests_stack = self._requests_stack
+        chunks = [requests_stack[i:i + BATCH_MAX_REQUESTS]
+                  for i in xrange(0, len(requests_stack), BATCH_MAX_REQUESTS)]
+        responses = [None] * len(requests_stack)
+        errors = []
+        for index, chunk, result, error in _imap_unordered(
+                self._execute_batch, chunks, self.batch_workers):
+            if error is not None:
+                logger.warning("Batch chunk %s failed: %s", index, error)
+                errors.append(error)
+                result = [error] * len(chunk)
+            offset = index * BATCH_MAX_REQUESTS
+            responses[offset:offset + len(chunk)] = result
+        if chunks and len(errors) == len(chunks):
+            raise errors[0]
+        return responses
+
+    def _execute_batch(self, requests_stack):
+        """Sends a single batch request and decodes its responses."""
+        post_args = {'batch': json.dumps(requests_stack)}
+        post_args.update(self._auth_args())
         logger.debug("Batch request to %s with %s requests",
                      self.base_url,
-                     len(self._requests_stack))
+                     len(requests_stack))
+        files = {}
+        for request in requests_stack:
+            for name in request.get('attached_files', '').split(','):
+                if name:
+                    files[name] = self._batch_files[name]
+        # A batch of reads is as safe to retry as a GET
+        method = "GET"
+        if any(request['method'] != "GET" for request in requests_stack):
+            method = "POST"
+        with self._instrument("batch", "POST", "", len(requests_stack)):
+            batch_response = self.retry_policy.call_method(
+                method, self._with_token_pool, post_args, self._post_batch,
+                post_args, files)
+        responses = []
+        for response in self.json_loads(batch_response.content):
+            try:
+                headers = requests.structures.CaseInsensitiveDict()
+                for header in response.get('headers', []):
+                    headers[header['name']] = header['value']
+                result = self._handle_response(response['code'],
+                                               headers,
+                                               response['body'])
+                responses.append(result)
+            except Exception, e:
+                responses.append(e)
+        return responses
+
+
+    def _post_batch(self, post_args, files=None):
+        kwargs = {'data': post_args}
+        if files:
+            # Rewind the files, which an earlier attempt may have read
+            for fileobj, position in files.values():
+                if hasattr(fileobj, 'seek'):
+                    fileobj.seek(position)
+            if MultipartEncoder is not None:
+                # Stream the files instead of building the body in memory
+                fields = dict(post_args)
+                for name, (fileobj, _) in files.items():
+                    fields[name] = (name, fileobj)
+                encoder = MultipartEncoder(fields)
+                kwargs = {'data': encoder,
+                          'headers': {'Content-Type': encoder.content_type}}
+            else:
+                kwargs['files'] = dict((name, fileobj) for name, (fileobj, _)
+                                       in files.items())
         try:
-            batch_response = requests.post(self.base_url,
-                                           post_args,
-                                           timeout=self.timeout)
+            batch_response = self._send("POST",
+                                        self.base_url,
+                                        **kwargs)
             batch_response.raise_for_status()
         except requests.HTTPError as e:
             response = getattr(e, 'response', None)
@@ -415,23 +1295,15 @@ class GraphAPI(object):
                 except:
                     pass
                 if error_data:
-                    raise GraphAPIError(error_data)
-            # Fallback to just creating a GraphAPIError obj out of `e`
+                    error = GraphAPIError(error_data)
+                else:
+                    # Fallback to just creating a GraphAPIError obj out of `e`
+                    error = GraphAPIError(e)
+                error.status_code = response.status_code
+                error.headers = response.headers
+                raise error
             raise GraphAPIError(e)
-        responses = []
-        for response in batch_response.json():
-            try:
-                headers = {}
-                for header in response.get('headers', []):
-                    headers[header['name']] = header['value']
-                result = self._handle_response(response['code'],
-                                               headers,
-                                               response['body'])
-                responses.append(result)
-            except Exception, e:
-                responses.append(e)
-        return responses
-
+        return batch_response
 
     def fql(self, query):
         """FQL query.
@@ -501,9 +1373,1654 @@ class GraphAPI(object):
         return self.request("debug_token", args)
 
 
+class Field(object):
+    """A field to request, optionally with modifiers and subfields.
+
+    Modifiers such as limit or summary apply to the field itself and
+    subfields pick what is returned for each of its objects, so
+
+        Field("comments", "message", Field("from", "name"), limit=5)
+
+    renders as comments.limit(5){message,from{name}}.
+
+    """
+    def __init__(self, name, *subfields, **modifiers):
+        self.name = name
+        self.subfields = subfields
+        self.modifiers = modifiers
+
+    def __str__(self):
+        field = self.name
+        for modifier, value in sorted(self.modifiers.items()):
+            if isinstance(value, bool):
+                value = value and "true" or "false"
+            field += ".%s(%s)" % (modifier, value)
+        if self.subfields:
+            field += "{%s}" % fields(self.subfields)
+        return field
+
+
+def fields(items):
+    """Renders field names and Fields as the value of a fields argument."""
+    if isinstance(items, Field):
+        items = [items]
+    return ",".join(str(item) for item in items)
+
+
+def _render_fields(args):
+    """Renders a list or Field passed as the fields argument, in place."""
+    if isinstance(args.get("fields"), (list, tuple, Field)):
+        args["fields"] = fields(args["fields"])
+    return args
+
+
+class GraphQuery(object):
+    """Builds a request for part of the graph. See GraphAPI.query()."""
+    def __init__(self, graph, path):
+        self.graph = graph
+        self.path = path
+        self._fields = []
+        self._args = {}
+
+    def fields(self, *items):
+        self._fields.extend(items)
+        return self
+
+    def limit(self, limit):
+        self._args["limit"] = limit
+        return self
+
+    def summary(self, summary=True):
+        self._args["summary"] = summary and "true" or "false"
+        return self
+
+    def params(self, **args):
+        self._args.update(args)
+        return self
+
+    def args(self):
+        """Returns the query string arguments for the request."""
+        args = dict(self._args)
+        if self._fields:
+            args["fields"] = fields(self._fields)
+        return args
+
+    def get(self, **kwargs):
+        """Sends the request. Keyword arguments are passed to request()."""
+        return self.graph.request(self.path, self.args(), **kwargs)
+
+    def iter_pages(self, prefetch=None):
+        return self.graph.iter_pages(self.path, self.args(), prefetch=prefetch)
+
+    def __iter__(self):
+        return iter(GraphPager(self.graph, self.path, self.args(), items=True,
+                               prefetch=self.graph.prefetch_pages))
+
+
+class PageSizeTuner(object):
+    """Adjusts the page size of a paged request to its responses.
+
+    Small pages cost round trips and large pages time out on heavy
+    connections, so the `limit` of each next page is tuned between
+    min_limit and max_limit: it grows while full pages come back
+    faster than target_latency seconds, shrinks in proportion when
+    they are slower, and is halved when a page times out or the API
+    asks for less data (error code 1). With max_bytes, pages are also
+    kept to about that many bytes, which bounds the memory a page
+    takes however large its items are. Enable it per client with
+
+       graph = facebook.GraphAPI(access_token,
+                                 adaptive_paging=facebook.PageSizeTuner)
+
+    or pass any callable returning a tuner, such as
+    functools.partial(facebook.PageSizeTuner, max_bytes=2 ** 20).
+
+    """
+    GROWTH = 1.5
+
+    def __init__(self, min_limit=25, max_limit=1000, target_latency=2.0,
+                 limit=None, max_bytes=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        # Taken from the first page URL if not given
+        self.limit = limit
+
+    def apply(self, url):
+        """Returns url with its limit set to the current page size."""
+        if self.limit is None:
+            query = urlparse.urlsplit(url)[3]
+            try:
+                self.limit = int(parse_qs(query)["limit"][0])
+            except (KeyError, ValueError):
+                return url
+        self.limit = max(self.min_limit, min(self.limit, self.max_limit))
+        return _update_url_query(url, limit=self.limit)
+
+    def record(self, items, latency, size=None):
+        """Adjusts the page size after a page of items was received.
+
+        size is the length of the page in bytes, if known.
+        """
+        if self.limit is None:
+            return
+        # The most items expected to fit in max_bytes
+        fits = None
+        if self.max_bytes and items and size:
+            fits = int(self.max_bytes * items / size)
+        if latency > self.target_latency:
+            limit = int(self.limit * self.target_latency / latency)
+            if fits is not None:
+                limit = min(limit, fits)
+        elif fits is not None and fits < self.limit:
+            limit = fits
+        elif items >= self.limit:
+            # Only full pages show that a bigger page would help
+            limit = int(self.limit * self.GROWTH)
+            if fits is not None:
+                limit = min(limit, fits)
+        else:
+            return
+        self.limit = max(self.min_limit, min(limit, self.max_limit))
+
+    def is_too_large(self, error):
+        return (isinstance(error, requests.Timeout) or
+                getattr(error, 'type', None) == 1)
+
+    def can_shrink(self):
+        return self.limit is not None and self.limit > self.min_limit
+
+    def shrink(self):
+        """Halves the page size; returns False if it cannot shrink."""
+        if not self.can_shrink():
+            return False
+        self.limit = max(self.min_limit, self.limit // 2)
+        return True
+
+
+class _PageTooLarge(Exception):
+    """Carries an error the PageSizeTuner handles past the retry policy."""
+    def __init__(self, error):
+        Exception.__init__(self, str(error))
+        self.error = error
+
+
+class GraphPager(object):
+    """Iterates over a paged Graph API response one page at a time.
+
+    Each page is fetched only when the previous one has been consumed,
+    and nothing is kept once it has been handed to the caller. With
+    items=True the entries of each page's "data" list are yielded
+    instead of the pages themselves:
+
+       pager = graph.iter_connections("me", "feed")
+       for post in pager:
+           process(post)
+           if done:
+               save(pager.cursors.get("after"))
+               break
+
+    next_url and cursors reflect the "paging" block of the most
+    recently fetched page.
+
+    state() describes how far the caller has got, assuming everything
+    yielded so far has been processed. It can be stored as JSON and
+    passed back as `state` to carry on where the pager left off. With
+    a `checkpoint` filename, the state is written to that file after
+    every `checkpoint_every` pages, and an existing checkpoint is
+    resumed from. Access tokens are never part of the state.
+
+    """
+    def __init__(self, graph, path, args=None, method=None, items=False,
+                 prefetch=0, state=None, checkpoint=None, checkpoint_every=1):
+        self.graph = graph
+        self.path = path
+        self.args = args or {}
+        self.method = method or "GET"
+        self.items = items
+        # Number of pages fetched ahead on a background thread while the
+        # caller is still processing the current one
+        self.prefetch = prefetch
+        # Adjusts the page size as we go, if the client asks for it
+        self.tuner = graph._page_size_tuner()
+        assert checkpoint_every >= 1, "checkpoint_every must be at least 1"
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        if state is None and checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                state = json.load(f)
+        self.next_url = None
+        self.cursors = {}
+        self.pages_seen = 0
+        self.items_seen = 0
+        self.done = False
+        # The URL of the current page (None for the first page) and how
+        # many of its items have been yielded
+        self._page_url = None
+        self._page_size = 0
+        self._position = 0
+        self._resume = state
+        if state:
+            self.cursors = state.get('cursors') or {}
+            self.pages_seen = state.get('pages_seen', 0)
+            self.items_seen = state.get('items_seen', 0)
+            self.done = state.get('done', False)
+
+    def __iter__(self):
+        if self.items:
+            return self._iter_items()
+        return self._iter_pages()
+
+    def state(self):
+        """Returns a JSON serializable description of our progress."""
+        if self.items and self._position < self._page_size:
+            url, position = self._page_url, self._position
+        else:
+            url, position = self.next_url, 0
+        if url:
+            url = _update_url_query(url, access_token=None,
+                                    appsecret_proof=None)
+        return {"path": self.path,
+                "args": dict((k, v) for k, v in self.args.items()
+                             if k not in AUTH_ARGS),
+                "method": self.method,
+                "url": url,
+                "position": position,
+                "cursors": self.cursors,
+                "pages_seen": self.pages_seen,
+                "items_seen": self.items_seen,
+                "done": self.done}
+
+    def save(self, filename):
+        """Writes state() to filename, replacing it atomically."""
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump(self.state(), f)
+        os.rename(temp_filename, filename)
+
+    def _iter_pages(self):
+        if self.prefetch:
+            pages = self._prefetch_pages()
+        else:
+            pages = self._fetch_pages()
+        position = 0
+        if self._resume:
+            position = self._resume.get('position', 0)
+        try:
+            for page_url, page in pages:
+                data = page.get('data') or []
+                paging = page.get('paging') or {}
+                self.next_url = paging.get('next')
+                self.cursors = paging.get('cursors') or self.cursors
+                self._page_url = page_url
+                self._page_size = len(data)
+                self._position = position
+                if not position:
+                    # Pages partly seen before resuming were counted then
+                    self.pages_seen += 1
+                    if not self.items:
+                        self.items_seen += len(data)
+                position = 0
+                yield page
+                if (self.checkpoint and
+                        not self.pages_seen % self.checkpoint_every):
+                    self.save(self.checkpoint)
+        except GraphAPIError as e:
+            e.pages_seen = self.pages_seen
+            e.paging_state = self.state()
+            raise e
+        self.done = True
+        if self.checkpoint:
+            self.save(self.checkpoint)
+
+    def _iter_items(self):
+        for page in self._iter_pages():
+            data = page.get('data') or []
+            while self._position < len(data):
+                self._position += 1
+                self.items_seen += 1
+                yield data[self._position - 1]
+
+    def _fetch_pages(self):
+        if self._resume:
+            if self._resume.get('done'):
+                return
+            page_url = self._resume.get('url')
+        else:
+            page_url = None
+        if page_url is None:
+            page = self.graph.request(self.path, dict(self.args),
+                                      method=self.method, follow_paging=False)
+        else:
+            page = self._get_page(page_url)
+        while True:
+            yield page_url, page
+            page_url = (page.get('paging') or {}).get('next')
+            if not page_url:
+                return
+            page = self._get_page(page_url)
+
+    def _get_page(self, url):
+        if "access_token=" not in url:
+            # URLs from saved state have had the token removed
+            url = _update_url_query(url, **self.graph._auth_args())
+        return self.graph._get_next_page(self.method, url, self.tuner)
+
+    def _prefetch_pages(self):
+        # The buffer bounds how far ahead of the caller the worker may get
+        buf = Queue.Queue(self.prefetch)
+        stopped = threading.Event()
+
+        def _worker():
+            try:
+                for page in self._fetch_pages():
+                    if not _put_unless_stopped(buf, (page, None), stopped):
+                        return
+            except Exception as e:
+                _put_unless_stopped(buf, (None, e), stopped)
+            else:
+                _put_unless_stopped(buf, (None, None), stopped)
+
+        worker = threading.Thread(target=_worker)
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                page, error = buf.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    return
+                yield page
+        finally:
+            # Lets the worker exit if the caller stops iterating early
+            stopped.set()
+
+
+class GraphFuture(object):
+    """The eventual result of a Graph API call made by AsyncGraphAPI.
+
+    result() blocks until the call has finished and returns its result
+    or raises its error. Callbacks added with add_done_callback() are
+    called with the future once it is done, on the thread that
+    completed it.
+
+    """
+    def __init__(self):
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._finished.is_set()
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._error
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def _wait(self, timeout):
+        if not self._finished.wait(timeout) and not self._finished.is_set():
+            raise GraphAPIError("Timed out waiting for the Graph API result")
+
+    def _finish(self, result, error):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("Exception in GraphFuture callback")
+
+
+class AsyncGraphAPI(object):
+    """A non-blocking client for the Facebook Graph API.
+
+    Mirrors the request methods of GraphAPI, but each call returns a
+    GraphFuture straight away instead of waiting for the response.
+    Up to `concurrency` calls run at the same time over a shared pool
+    of keep-alive connections; further calls queue until a slot is
+    free. Paging and retries behave exactly as they do in GraphAPI:
+
+       graph = facebook.AsyncGraphAPI(access_token, concurrency=50)
+       futures = [graph.get_object(id) for id in ids]
+       profiles = [f.result() for f in futures]
+
+    Other keyword arguments are passed on to the underlying GraphAPI,
+    or an existing client can be wrapped by passing it as `graph`.
+
+    """
+    def __init__(self, access_token=None, concurrency=DEFAULT_CONCURRENCY,
+                 graph=None, **kwargs):
+        if graph is None:
+            kwargs.setdefault('pool_size', max(concurrency, DEFAULT_POOL_SIZE))
+            graph = GraphAPI(access_token, **kwargs)
+        self.graph = graph
+        self.concurrency = concurrency
+        self._tasks = Queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.graph.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.graph.__exit__(exc_type, exc_value, traceback)
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs) and returns a GraphFuture."""
+        future = GraphFuture()
+        if self.graph._batch_request:
+            # Calls made in batch mode only add to the request stack
+            self._run(future, fn, args, kwargs)
+            return future
+        self._start_workers()
+        self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def close(self):
+        """Stops the worker threads once queued calls have finished."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._tasks.put(None)
+        for worker in workers:
+            worker.join()
+        self.graph.close()
+
+    def _start_workers(self):
+        with self._lock:
+            if self._workers:
+                return
+            for _ in xrange(self.concurrency):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            self._run(*task)
+
+    def _run(self, future, fn, args, kwargs):
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def get_object(self, id, **args):
+        return self.submit(self.graph.get_object, id, **args)
+
+    def get_objects(self, ids, **args):
+        return self.submit(self.graph.get_objects, ids, **args)
+
+    def get_connections(self, id, connection_name, **args):
+        return self.submit(self.graph.get_connections, id, connection_name,
+                           **args)
+
+    def put_object(self, parent_object, connection_name, **data):
+        return self.submit(self.graph.put_object, parent_object,
+                           connection_name, **data)
+
+    def put_photo(self, image, message=None, album_id=None, **kwargs):
+        return self.submit(self.graph.put_photo, image, message, album_id,
+                           **kwargs)
+
+    def request(self, path, args=None, post_args=None, files=None,
+                method=None, follow_paging=None):
+        return self.submit(self.graph.request, path, args, post_args, files,
+                           method, follow_paging)
+
+    def execute(self):
+        return self.submit(self.graph.execute)
+
+    def iter_pages(self, path, args=None, method=None, prefetch=1):
+        """Iterates over the pages of a paged response.
+
+        The next page is fetched in the background while the caller
+        processes the current one.
+        """
+        return self.graph.iter_pages(path, args, method, prefetch=prefetch)
+
+    def iter_connections(self, id, connection_name, **args):
+        """Iterates over the connections for given object, one by one.
+
+        The next page is fetched in the background while the caller
+        processes the current one.
+        """
+        return GraphPager(self.graph, id + "/" + connection_name, args,
+                          items=True, prefetch=1)
+
+
+class BatchDispatcher(object):
+    """Combines reads made from many threads into batch requests.
+
+    Calls return a GraphFuture right away. Calls arriving within
+    `window` seconds of each other are sent together in one batch
+    request, or sooner once `max_size` of them are queued, and each
+    future is resolved with its own result or error:
+
+       dispatcher = facebook.BatchDispatcher(graph, window=0.01)
+       # On any number of threads:
+       profile = dispatcher.get_object(id).result()
+
+    Like execute(), connections come back one page at a time; paging
+    is not followed. Up to graph.batch_workers batches are in flight
+    at once. close() sends anything still queued and stops the
+    dispatcher.
+
+    """
+    def __init__(self, graph, window=0.005, max_size=BATCH_MAX_REQUESTS):
+        self.graph = graph
+        self.window = window
+        self.max_size = min(max_size, BATCH_MAX_REQUESTS)
+        self._pending = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self._slots = threading.Semaphore(max(graph.batch_workers, 1))
+        self._collector = None
+
+    def get_object(self, id, **args):
+        return self.request(id, args)
+
+    def get_connections(self, id, connection_name, **args):
+        return self.request(id + "/" + connection_name, args)
+
+    def request(self, path, args=None):
+        """Queues a GET request for path and returns a GraphFuture."""
+        future = GraphFuture()
+        entry = self.graph._batch_entry("GET", path,
+                                        _render_fields(dict(args or {})))
+        with self._condition:
+            if self._closed:
+                raise GraphAPIError("BatchDispatcher has been closed")
+            if self._collector is None:
+                self._collector = threading.Thread(target=self._collect)
+                self._collector.daemon = True
+                self._collector.start()
+            self._pending.append((entry, future))
+            self._condition.notify()
+        return future
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            collector = self._collector
+        if collector is not None:
+            collector.join()
+
+    def _collect(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                deadline = time.time() + self.window
+                while len(self._pending) < self.max_size and not self._closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self.max_size]
+                del self._pending[:self.max_size]
+            self._slots.acquire()
+            dispatch = threading.Thread(target=self._dispatch, args=(batch,))
+            dispatch.daemon = True
+            dispatch.start()
+
+    def _dispatch(self, batch):
+        try:
+            try:
+                results = self.graph._execute_batch(
+                    [entry for entry, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+
+class _ChunkReader(object):
+    """Reads byte ranges of a file without loading all of it.
+
+    Real files are memory mapped; other file like objects are read
+    with seek() and read() under a lock, so that chunks can be read
+    from several threads.
+    """
+    def __init__(self, source):
+        self._owns_file = not hasattr(source, 'read')
+        if self._owns_file:
+            source = open(source, 'rb')
+        self._file = source
+        self._map = None
+        self._lock = threading.Lock()
+        try:
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = len(self._map)
+        except (AttributeError, IOError, OSError, ValueError):
+            source.seek(0, os.SEEK_END)
+            self.size = source.tell()
+
+    def read(self, start, end):
+        if self._map is not None:
+            return self._map[start:end]
+        with self._lock:
+            self._file.seek(start)
+            return self._file.read(end - start)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        if self._owns_file:
+            self._file.close()
+
+
+def _update_url_query(url, **params):
+    """Sets query string parameters of url, removing those set to None."""
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    query_params = parse_qs(query, keep_blank_values=True)
+    for name, value in params.items():
+        if value is None:
+            query_params.pop(name, None)
+        else:
+            query_params[name] = [str(value)]
+    query = urllib.urlencode(sorted(query_params.items()), doseq=True)
+    return urlparse.urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def _urlencode(params):
+    """Encodes a dict or sequence of pairs as a query string.
+
+    Unicode names and values are encoded to UTF-8, as requests sends
+    them, and list values become repeated parameters.
+    """
+    if hasattr(params, 'items'):
+        params = params.items()
+    encoded = []
+    for name, value in params:
+        if isinstance(value, (list, tuple)):
+            value = [_utf8(item) for item in value]
+        else:
+            value = _utf8(value)
+        encoded.append((_utf8(name), value))
+    return urllib.urlencode(encoded, doseq=True)
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _put_unless_stopped(queue, item, stopped):
+    """Puts item on a bounded queue, giving up once stopped is set.
+
+    Returns whether the item was queued.
+    """
+    while not stopped.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _get_unless_stopped(queue, stopped):
+    """Gets an item from a queue, giving up once stopped is set.
+
+    Returns None if stopped first.
+    """
+    while not stopped.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+    return None
+
+
+def _imap_unordered(func, items, max_workers):
+    """Calls func on each of items using at most max_workers threads.
+
+    Yields (index, item, result, error) tuples in completion order,
+    where error is the exception raised by func (and result is then
+    None). items is consumed lazily and at most max_workers results
+    are buffered, so memory stays bounded for long iterables.
+
+    """
+    if max_workers <= 1:
+        for index, item in enumerate(items):
+            try:
+                yield index, item, func(item), None
+            except Exception as e:
+                yield index, item, None, e
+        return
+
+    tasks = Queue.Queue(max_workers)
+    results = Queue.Queue(max_workers)
+    stopped = threading.Event()
+    done = object()
+
+    def _feeder():
+        try:
+            for task in enumerate(items):
+                if not _put_unless_stopped(tasks, task, stopped):
+                    return
+        except Exception as e:
+            _put_unless_stopped(results, (None, None, None, e), stopped)
+        for _ in xrange(max_workers):
+            _put_unless_stopped(tasks, done, stopped)
+
+    def _worker():
+        while True:
+            # The feeder stops without sending `done` if the caller does
+            task = _get_unless_stopped(tasks, stopped)
+            if task is None:
+                return
+            if task is done:
+                break
+            index, item = task
+            try:
+                outcome = (index, item, func(item), None)
+            except Exception as e:
+                outcome = (index, item, None, e)
+            if not _put_unless_stopped(results, outcome, stopped):
+                return
+        _put_unless_stopped(results, done, stopped)
+
+    threads = [threading.Thread(target=_feeder)]
+    threads += [threading.Thread(target=_worker) for _ in xrange(max_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = max_workers
+        while running:
+            outcome = results.get()
+            if outcome is done:
+                running -= 1
+            elif outcome[0] is None:
+                # The iterable itself raised
+                raise outcome[3]
+            else:
+                yield outcome
+    finally:
+        stopped.set()
+
+
+class RetryPolicy(object):
+    """Decides whether and when failed Graph API requests are retried.
+
+    Requests failing with one of `error_codes`, an HTTP status in
+    `statuses` or, if connection_errors is set, a connection error or
+    timeout are retried up to `retries` times. Requests other than
+    GETs may have taken effect before a server error or read timeout,
+    so they are only retried on error codes and failures to connect.
+    The wait before attempt n is drawn uniformly from zero up to
+    backoff * 2 ** (n - 1), capped at max_backoff ("full jitter", so
+    that many clients failing together don't retry in lockstep). With
+    exponential=False the wait stays at `backoff`, and with
+    jitter=False it is not randomized. A Retry-After header on the
+    response takes precedence. `budget` caps the total time spent
+    waiting over the attempts of one call.
+
+       policy = facebook.RetryPolicy(retries=5, backoff=1, budget=60)
+       graph = facebook.GraphAPI(access_token, retry_policy=policy)
+
+    """
+    # Unknown errors, temporary downtime, application and user rate
+    # limits and application limit reached
+    TRANSIENT_ERROR_CODES = (1, 2, 4, 17, 341)
+    RETRY_STATUSES = (500, 502, 503, 504)
+    IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30, budget=None,
+                 error_codes=TRANSIENT_ERROR_CODES, statuses=RETRY_STATUSES,
+                 connection_errors=True, exponential=True, jitter=True):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.error_codes = frozenset(error_codes)
+        self.statuses = frozenset(statuses)
+        self.connection_errors = connection_errors
+        self.exponential = exponential
+        self.jitter = jitter
+
+    def is_retryable(self, error, method="GET"):
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        if isinstance(error, GraphAPIError):
+            return (error.type in self.error_codes or
+                    (idempotent and error.status_code in self.statuses))
+        if not self.connection_errors:
+            return False
+        if idempotent:
+            return isinstance(error, (requests.ConnectionError,
+                                      requests.Timeout))
+        # Includes ConnectTimeout, but not a ReadTimeout after the
+        # request was sent
+        return isinstance(error, requests.ConnectionError)
+
+    def delay(self, attempt, error=None):
+        """Returns how long to wait before the given retry attempt."""
+        headers = getattr(error, 'headers', None) or {}
+        retry_after = headers.get('retry-after')
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        delay = self.backoff
+        if self.exponential:
+            delay = min(delay * 2 ** (attempt - 1), self.max_backoff)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def call(self, fn, *args, **kwargs):
+        """Calls fn, retrying it as long as the policy allows.
+
+        fn is retried as a GET request; use call_method() for others.
+        """
+        return self.call_method("GET", fn, *args, **kwargs)
+
+    def call_method(self, method, fn, *args, **kwargs):
+        """Calls fn, which sends a `method` request, retrying it as long
+        as the policy allows.
+        """
+        attempt = 0
+        waited = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if (attempt >= self.retries or
+                        not self.is_retryable(e, method)):
+                    raise e
+                attempt += 1
+                delay = self.delay(attempt, e)
+                if self.budget is not None and waited + delay > self.budget:
+                    logger.warning("Retry budget of %s seconds exhausted",
+                                   self.budget)
+                    raise e
+                logger.warning("Caught %s (type=%s), retrying in %.2f seconds "
+                               "(attempt %s of %s)",
+                               e, getattr(e, 'type', None), delay, attempt,
+                               self.retries)
+                if delay:
+                    time.sleep(delay)
+                waited += delay
+
+
+class GraphUsage(object):
+    """Rate limit utilization as last reported by the Graph API.
+
+    The X-App-Usage, X-Page-Usage and X-Business-Use-Case-Usage headers
+    of each response are parsed into `app`, `page` and `business`.
+    Their values are percentages of the limit. GraphAPI keeps one of
+    these up to date as its `usage` attribute.
+
+    """
+    def __init__(self):
+        self.app = {}
+        self.page = {}
+        self.business = {}
+        self.updated = None
+        self._lock = threading.Lock()
+
+    def update(self, headers):
+        usage = {}
+        for name in ('x-app-usage', 'x-page-usage',
+                     'x-business-use-case-usage'):
+            value = headers.get(name)
+            if not value:
+                continue
+            try:
+                usage[name] = json.loads(value)
+            except ValueError:
+                logger.warning("Could not parse %s header: %r", name, value)
+        if not usage:
+            return
+        with self._lock:
+            self.app = usage.get('x-app-usage', self.app)
+            self.page = usage.get('x-page-usage', self.page)
+            self.business = usage.get('x-business-use-case-usage',
+                                      self.business)
+            self.updated = time.time()
+
+    def utilization(self):
+        """Returns the highest reported usage, as a percentage."""
+        with self._lock:
+            counters = [self.app, self.page]
+            for entries in self.business.values():
+                counters.extend(entries)
+        values = [0]
+        for counter in counters:
+            for name in ('call_count', 'total_time', 'total_cputime'):
+                try:
+                    values.append(float(counter.get(name) or 0))
+                except (TypeError, ValueError):
+                    pass
+        return max(values)
+
+    def blocked_until(self):
+        """Returns when a throttled business use case regains access.
+
+        Returns None unless the Graph API has reported that access is
+        currently blocked.
+        """
+        with self._lock:
+            minutes = [entry.get('estimated_time_to_regain_access') or 0
+                       for entries in self.business.values()
+                       for entry in entries]
+            if not minutes or not max(minutes):
+                return None
+            return self.updated + max(minutes) * 60
+
+
+class RateLimiter(object):
+    """Paces requests with a token bucket that slows down under load.
+
+    Requests are let through at up to `rate` per second, with bursts
+    of up to `burst`. Once the utilization reported by the Graph API
+    passes `threshold` percent, the rate and burst are scaled down
+    linearly, reaching `min_rate` at 100%. While the API reports a business use
+    case as blocked, requests wait until it is expected to recover.
+
+    A limiter may be shared by several clients:
+
+       limiter = facebook.RateLimiter(rate=50)
+       graph = facebook.GraphAPI(access_token, rate_limiter=limiter)
+
+    """
+    def __init__(self, rate, burst=None, threshold=75, min_rate=0.5):
+        assert 0 <= threshold < 100, \
+            "threshold must be a percentage below 100"
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate), 1)
+        self.threshold = threshold
+        self.min_rate = min_rate
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def current_rate(self, utilization):
+        if utilization <= self.threshold:
+            return self.rate
+        headroom = max(100.0 - utilization, 0) / (100.0 - self.threshold)
+        return max(self.rate * headroom, self.min_rate)
+
+    def acquire(self, usage=None):
+        """Blocks until a request may be sent."""
+        rate = self.rate
+        blocked_until = None
+        if usage is not None:
+            rate = self.current_rate(usage.utilization())
+            blocked_until = usage.blocked_until()
+        # The burst shrinks along with the rate, so that slowing down
+        # takes effect straight away rather than once the bucket is empty
+        burst = max(self.burst * rate / self.rate, 1)
+        with self._lock:
+            now = time.time()
+            self._tokens = min(burst,
+                               self._tokens + (now - self._last) * rate)
+            self._last = now
+            # Reserve a token, even if it has yet to be refilled
+            self._tokens -= 1
+            delay = self._tokens < 0 and -self._tokens / rate or 0
+        if blocked_until is not None:
+            delay = max(delay, blocked_until - time.time())
+        if delay > 0:
+            logger.debug("Rate limiter delaying request by %.3f seconds",
+                         delay)
+            time.sleep(delay)
+
+
+class _CallStats(object):
+    """What the HTTP requests made for one instrumented call added up to."""
+    __slots__ = ('attempts', 'pages', 'status', 'bytes_in', 'bytes_out')
+
+    def __init__(self):
+        self.attempts = 0
+        self.pages = 1
+        self.status = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+class GraphMetrics(object):
+    """Aggregates request events into counters and latency histograms.
+
+    An instance is a hook for GraphAPI, and renders what it has seen in
+    the Prometheus text exposition format:
+
+       metrics = facebook.GraphMetrics()
+       graph = facebook.GraphAPI(access_token, hooks=[metrics])
+       ...
+       body = metrics.render_prometheus()
+
+    Series are labelled by kind, endpoint and method, so endpoints with
+    many distinct non-numeric names (such as usernames) will produce
+    many series.
+
+    """
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, prefix="facebook_graph", buckets=LATENCY_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self._counters = collections.defaultdict(float)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        labels = (("kind", event["kind"]),
+                  ("endpoint", event["endpoint"]),
+                  ("method", event["method"]))
+        status = (("status", str(event["status"])),)
+        with self._lock:
+            counters = self._counters
+            counters[("requests_total", labels + status)] += 1
+            counters[("retries_total", labels)] += event["retries"]
+            counters[("pages_total", labels)] += event["pages"]
+            counters[("received_bytes_total", labels)] += event["bytes_in"]
+            counters[("sent_bytes_total", labels)] += event["bytes_out"]
+            if event["batch_size"]:
+                counters[("batched_requests_total", labels)] += \
+                    event["batch_size"]
+            if event["error"] is not None:
+                code = (("error_code", str(event["error_code"])),)
+                counters[("errors_total", labels + code)] += 1
+            histogram = self._histograms.get(labels)
+            if histogram is None:
+                histogram = self._histograms[labels] = \
+                    [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if event["latency"] <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += event["latency"]
+
+    def render_prometheus(self):
+        """Returns the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            by_name = collections.defaultdict(list)
+            for (name, labels), value in self._counters.items():
+                by_name[name].append((labels, value))
+            for name in sorted(by_name):
+                metric = "%s_%s" % (self.prefix, name)
+                lines.append("# TYPE %s counter" % metric)
+                for labels, value in sorted(by_name[name]):
+                    lines.append("%s%s %s" % (
+                        metric, _prometheus_labels(labels),
+                        _prometheus_value(value)))
+            metric = "%s_latency_seconds" % self.prefix
+            if self._histograms:
+                lines.append("# TYPE %s histogram" % metric)
+            histograms = sorted(self._histograms.items())
+            for labels, (counts, count, total) in histograms:
+                for bound, bucket_count in zip(self.buckets, counts):
+                    bucket = labels + (("le", _prometheus_value(bound)),)
+                    lines.append("%s_bucket%s %s" % (
+                        metric, _prometheus_labels(bucket), bucket_count))
+                bucket = labels + (("le", "+Inf"),)
+                lines.append("%s_bucket%s %s" % (
+                    metric, _prometheus_labels(bucket), count))
+                lines.append("%s_sum%s %s" % (
+                    metric, _prometheus_labels(labels), repr(total)))
+                lines.append("%s_count%s %s" % (
+                    metric, _prometheus_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_labels(labels):
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, _prometheus_escape(value))
+        for name, value in labels)
+
+
+def _prometheus_escape(value):
+    """Escapes a label value as the Prometheus text format requires."""
+    return (value.replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _prometheus_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _endpoint_template(path):
+    """Reduces a path or URL to the endpoint it addresses.
+
+    Numeric IDs (including compound ones like 123_456) become {id},
+    and the query string and API version are dropped.
+    """
+    if "://" in path:
+        path = urlparse.urlsplit(path)[2]
+    segments = [segment for segment in path.split("?")[0].split("/")
+                if segment]
+    if segments and re.match(r"^v\d+\.\d+$", segments[0]):
+        segments = segments[1:]
+    return "/" + "/".join(re.match(r"^[\d_]+$", segment) and "{id}" or segment
+                          for segment in segments)
+
+
+class GraphCache(object):
+    """An in-memory cache of Graph API GET responses.
+
+    Responses are kept for `ttl` seconds and the least recently used
+    ones are evicted once more than `max_size` are held. Errors that
+    won't go away by retrying (missing objects, missing permissions)
+    are cached for `error_ttl` seconds. Expired entries that carried
+    an ETag are revalidated rather than fetched again.
+
+    With ignore_token=True the access token is left out of the cache
+    key, so clients using different tokens share entries. Only do
+    this when every token sees the same data.
+
+    Cached results are shared between callers and must not be
+    modified. The cache is safe to share between threads and clients:
+
+       cache = facebook.GraphCache(ttl=600, max_size=10000)
+       graph = facebook.GraphAPI(access_token, cache=cache)
+
+    """
+    # Graph error codes for unsupported requests, permission failures
+    # and unknown aliases
+    CACHEABLE_ERROR_CODES = frozenset([10, 100, 803] + list(range(200, 300)))
+
+    def __init__(self, ttl=300, max_size=1024, error_ttl=60,
+                 ignore_token=False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.error_ttl = error_ttl
+        self.ignore_token = ignore_token
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, url, params=None):
+        params = sorted((params or {}).items())
+        if self.ignore_token:
+            params = [(k, v) for k, v in params if k not in AUTH_ARGS]
+        return url + "?" + _urlencode(params)
+
+    def get(self, key):
+        """Returns the entry for key, even if it has expired, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, result=None, error=None, etag=None):
+        if error is None:
+            ttl = self.ttl
+        else:
+            ttl = self.error_ttl
+        entry = _CacheEntry(time.time() + ttl, result, error, etag)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def is_cacheable_error(self, error):
+        return (self.error_ttl > 0 and
+                (error.status_code == 404 or
+                 error.type in self.CACHEABLE_ERROR_CODES))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _CacheEntry(object):
+    __slots__ = ('expires', 'result', 'error', 'etag')
+
+    def __init__(self, expires, result, error, etag):
+        self.expires = expires
+        self.result = result
+        self.error = error
+        self.etag = etag
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+
+def _copy_error(error, paging=False):
+    """Returns a copy of a GraphAPIError without the attributes callers
+    may have added to it.
+
+    With paging=True, what follow_paging recorded about the pages read
+    before the failure (data, pages_seen and next_url) is copied too.
+
+    """
+    copied = GraphAPIError(error.result, error.status_code)
+    copied.headers = error.headers
+    if paging:
+        for name in ('data', 'pages_seen', 'next_url'):
+            if hasattr(error, name):
+                setattr(copied, name, copy.deepcopy(getattr(error, name)))
+    return copied
+
+
+class _TokenCacheBase(object):
+    """What TokenCache and SharedTokenCache have in common."""
+
+    def __init__(self, default_ttl):
+        self.default_ttl = default_ttl
+
+    def key(self, user_id, code):
+        # Codes are long; keep keys short enough for memcached
+        return "%s:%s" % (user_id,
+                          hashlib.sha256(code.encode('utf-8')).hexdigest())
+
+
+class TokenCache(_TokenCacheBase):
+    """An in-memory cache of the access tokens get_user_from_cookie
+    gets for the code in each signed request.
+
+    Tokens are kept until they expire, or for `default_ttl` seconds if
+    Facebook doesn't say when they do, and the least recently used
+    ones are evicted once more than `max_size` are held. Repeat page
+    views with the same cookie then need no request to Facebook:
+
+       token_cache = facebook.TokenCache()
+       user = facebook.get_user_from_cookie(cookies, app_id, app_secret,
+                                            token_cache=token_cache)
+
+    Use a SharedTokenCache to share tokens between processes. The cache
+    is safe to share between threads.
+
+    """
+    def __init__(self, max_size=1024, default_ttl=3600):
+        _TokenCacheBase.__init__(self, default_ttl)
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the token result cached under key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                return None
+            self._entries[key] = entry
+        return _remaining_token(*entry)
+
+    def set(self, key, result):
+        expires = time.time() + _token_ttl(result, self.default_ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, result)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedTokenCache(_TokenCacheBase):
+    """A TokenCache kept in a shared backend such as memcached.
+
+    `client` needs memcached style get(key) and set(key, value, ttl)
+    methods, as python-memcached and pymemcache clients have. Entries
+    are stored as JSON strings under keys starting with `prefix`.
+    Failures of the backend are logged and treated as cache misses.
+    LocalCacheClient stands in for a backend in development and tests:
+
+       client = memcache.Client(["127.0.0.1:11211"])
+       token_cache = facebook.SharedTokenCache(client)
+
+    Keys also carry a version, kept in the backend, which clear()
+    changes to drop the entries of every process at once; the old
+    entries are left to expire.
+
+    """
+    def __init__(self, client, prefix="facebook:token:", default_ttl=3600):
+        _TokenCacheBase.__init__(self, default_ttl)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            value = self.client.get(self._versioned(key))
+        except Exception as e:
+            logger.warning("Could not read token cache: %s", e)
+            return None
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        expires, result = json.loads(value)
+        if expires <= time.time():
+            return None
+        return _remaining_token(expires, result)
+
+    def set(self, key, result):
+        ttl = _token_ttl(result, self.default_ttl)
+        value = json.dumps([time.time() + ttl, result])
+        try:
+            self.client.set(self._versioned(key), value, int(ttl))
+        except Exception as e:
+            logger.warning("Could not write token cache: %s", e)
+
+    def clear(self):
+        version = "%x" % random.getrandbits(32)
+        try:
+            self.client.set(self.prefix + "version", version, 0)
+        except Exception as e:
+            logger.warning("Could not clear token cache: %s", e)
+
+    def _versioned(self, key):
+        version = self.client.get(self.prefix + "version")
+        if isinstance(version, bytes):
+            version = version.decode('utf-8')
+        return "%s%s:%s" % (self.prefix, version or 0, key)
+
+
+class LocalCacheClient(object):
+    """A memcached style client backed by a dictionary in this process."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._values.get(key, (None, None))
+            if expires and expires <= time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, expire=0):
+        expires = expire and time.time() + expire or None
+        with self._lock:
+            self._values[key] = (value, expires)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._values.pop(key, None) is not None
+
+
+def _token_ttl(result, default_ttl):
+    """Returns the seconds until the token in result expires."""
+    expires = result.get("expires_in", result.get("expires"))
+    try:
+        return int(expires)
+    except (TypeError, ValueError):
+        return default_ttl
+
+
+def _remaining_token(expires, result):
+    """Returns a copy of a cached token result whose lifetime counts
+    down from the time it is served.
+
+    """
+    result = dict(result)
+    remaining = int(expires - time.time())
+    for name in ("expires_in", "expires"):
+        if name in result:
+            result[name] = type(result[name])(remaining)
+    return result
+
+
+class AppTokenManager(object):
+    """Supplies an app's access token and the appsecret_proof of tokens.
+
+    The app access token is fetched on first use and kept until it
+    expires. The appsecret_proof (the access token signed with the
+    app secret), which apps with "Require App Secret" enabled must send
+    with every call, is computed once per token for the last
+    `max_proofs` tokens. GraphAPI adds both to its requests:
+
+       manager = facebook.AppTokenManager(app_id, app_secret)
+       # Makes requests with the app access token
+       graph = facebook.GraphAPI(token_manager=manager)
+       # Makes requests with user_token and its appsecret_proof
+       graph = facebook.GraphAPI(user_token, token_manager=manager)
+
+    Without an app_id only proofs are available. The manager is safe to
+    share between threads and clients.
+
+    """
+    # Seconds before it expires at which the app token is refreshed
+    EXPIRY_MARGIN = 60
+
+    def __init__(self, app_id, app_secret, timeout=None, base_url=None,
+                 max_proofs=1024):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.timeout = timeout
+        self.base_url = base_url
+        self.max_proofs = max_proofs
+        self._key = app_secret.encode('ascii')
+        self._token = None
+        self._expires = None
+        self._token_lock = threading.Lock()
+        self._proofs = collections.OrderedDict()
+        self._proofs_lock = threading.Lock()
+
+    def get_app_access_token(self):
+        """Returns the app access token, fetching it if needed."""
+        assert self.app_id, "Fetching the app access token needs an app_id"
+        with self._token_lock:
+            if self._token is None or (self._expires is not None and
+                                       time.time() >= self._expires):
+                self._fetch_token()
+            return self._token
+
+    def invalidate(self):
+        """Forgets the app access token, e.g. after it was revoked."""
+        with self._token_lock:
+            self._token = None
+
+    def appsecret_proof(self, access_token):
+        """Returns the appsecret_proof to send along with access_token."""
+        with self._proofs_lock:
+            proof = self._proofs.pop(access_token, None)
+        if proof is None:
+            proof = hmac.new(self._key, access_token.encode('ascii'),
+                             hashlib.sha256).hexdigest()
+        with self._proofs_lock:
+            self._proofs[access_token] = proof
+            while len(self._proofs) > self.max_proofs:
+                self._proofs.popitem(last=False)
+        return proof
+
+    def _fetch_token(self):
+        args = {'grant_type': 'client_credentials',
+                'client_id': self.app_id,
+                'client_secret': self.app_secret}
+        with contextlib.closing(GraphAPI(timeout=self.timeout,
+                                         base_url=self.base_url)) as graph:
+            result = graph.request("oauth/access_token", args=args)
+        self._token = result["access_token"]
+        ttl = _token_ttl(result, None)
+        if ttl is None:
+            # App access tokens usually don't expire
+            self._expires = None
+        else:
+            self._expires = time.time() + ttl - min(self.EXPIRY_MARGIN,
+                                                    ttl / 2.0)
+
+
+class TokenPool(object):
+    """Spreads requests over several access tokens.
+
+    Each request made by a GraphAPI created with a token pool (and no
+    access_token of its own) takes the next available token in turn.
+    A token rests after a rate limit error, for as long as the
+    response's Retry-After header says or else `cooldown` seconds,
+    and while the usage headers of its responses report more than
+    `threshold` percent utilization or a blocked business use case.
+    Tokens that turn out to be invalid or expired are dropped. The
+    failed request is then retried with another token:
+
+       pool = facebook.TokenPool(page_tokens)
+       graph = facebook.GraphAPI(token_pool=pool)
+       posts = [graph.get_connections(id, "posts") for id in page_ids]
+
+    When every token is resting, the one that recovers first is used.
+    Tokens are taken to be interchangeable, so a GraphCache and
+    single_flight share responses between them. The pool is safe to
+    share between threads and clients.
+
+    """
+    # Application, user, page and custom rate limits
+    THROTTLE_ERROR_CODES = frozenset([4, 17, 32, 613])
+    # Invalid, expired or revoked tokens and sessions
+    INVALID_ERROR_CODES = frozenset([102, 190])
+
+    def __init__(self, tokens, cooldown=60, threshold=90):
+        self.cooldown = cooldown
+        self.threshold = threshold
+        self._tokens = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._next = 0
+        for token in tokens:
+            self.add(token)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tokens)
+
+    def add(self, token):
+        with self._lock:
+            if token not in self._tokens:
+                self._tokens[token] = _PooledToken(token)
+
+    def remove(self, token):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def acquire(self):
+        """Returns the token to use for the next request."""
+        return self._choose(advance=True)
+
+    def peek(self):
+        """Returns the token acquire() would return, without taking it."""
+        return self._choose(advance=False)
+
+    def _choose(self, advance):
+        now = time.time()
+        with self._lock:
+            entries = list(self._tokens.values())
+            if not entries:
+                raise GraphAPIError("No valid access tokens left in the pool")
+            count = len(entries)
+            for i in range(count):
+                entry = entries[(self._next + i) % count]
+                if self._resting_until(entry, now) <= now:
+                    if advance:
+                        self._next = (self._next + i + 1) % count
+                    return entry.token
+            entry = min(entries, key=lambda e: self._resting_until(e, now))
+            return entry.token
+
+    def update(self, token, headers):
+        """Records the usage headers of a response to a token's request."""
+        entry = self._tokens.get(token)
+        if entry is not None:
+            entry.usage.update(headers)
+
+    def report_error(self, token, error):
+        """Records a failed request made with token.
+
+        Returns whether the request is worth retrying with another
+        token.
+        """
+        code = getattr(error, 'type', None)
+        if code in self.INVALID_ERROR_CODES:
+            logger.warning("Dropping invalid token from the pool: %s", error)
+            self.remove(token)
+            return True
+        if code not in self.THROTTLE_ERROR_CODES:
+            return False
+        entry = self._tokens.get(token)
+        if entry is not None:
+            retry_after = (getattr(error, 'headers', None) or {}).get(
+                'retry-after')
+            try:
+                cooldown = float(retry_after)
+            except (TypeError, ValueError):
+                cooldown = self.cooldown
+            logger.info("Resting throttled token for %s seconds", cooldown)
+            entry.resting_until = time.time() + cooldown
+        return True
+
+    def _resting_until(self, entry, now):
+        until = entry.resting_until
+        usage = entry.usage
+        # Usage that hasn't been reported again for a while is stale
+        if usage.updated is not None and usage.updated + self.cooldown > now:
+            blocked_until = usage.blocked_until()
+            if blocked_until is not None:
+                until = max(until, blocked_until)
+            if usage.utilization() > self.threshold:
+                until = max(until, usage.updated + self.cooldown)
+        return until
+
+
+class _PooledToken(object):
+    __slots__ = ('token', 'usage', 'resting_until')
+
+    def __init__(self, token):
+        self.token = token
+        self.usage = GraphUsage()
+        self.resting_until = 0
+
+
 class GraphAPIError(Exception):
     def __init__(self, result, status_code=None):
         self.result = result
+        self.status_code = status_code
+        # Headers of the response, where there was one
+        self.headers = None
         if status_code:
             self.type = status_code
         else:
@@ -530,7 +3047,8 @@ class GraphAPIError(Exception):
         Exception.__init__(self, self.message)
 
 
-def get_user_from_cookie(cookies, app_id, app_secret, call_facebook=True):
+def get_user_from_cookie(cookies, app_id, app_secret, call_facebook=True,
+                         verifier=None, token_cache=None):
     """Parses the cookie set by the official Facebook JavaScript SDK.
 
     cookies should be a dictionary-like object mapping cookie names to
@@ -547,19 +3065,36 @@ def get_user_from_cookie(cookies, app_id, app_secret, call_facebook=True):
     authentication at
     http://developers.facebook.com/docs/authentication/.
 
+    Pass a SignedRequestVerifier for app_secret as `verifier` to avoid
+    verifying the same cookie again on every request, and a TokenCache
+    as `token_cache` to avoid asking Facebook for its access token
+    again.
+
     """
     cookie = cookies.get("fbsr_" + app_id, "")
     if not cookie:
         return None
-    parsed_request = parse_signed_request(cookie, app_secret)
+    if verifier is not None:
+        parsed_request = verifier.parse(cookie)
+    else:
+        parsed_request = parse_signed_request(cookie, app_secret)
     if not parsed_request:
         return None
     if call_facebook:
-        try:
-            result = get_access_token_from_code(parsed_request["code"], "",
-                                                app_id, app_secret)
-        except GraphAPIError:
-            return None
+        result = None
+        if token_cache is not None:
+            key = token_cache.key(parsed_request["user_id"],
+                                  parsed_request["code"])
+            result = token_cache.get(key)
+        if result is None:
+            try:
+                result = get_access_token_from_code(parsed_request["code"],
+                                                    "", app_id, app_secret)
+            except GraphAPIError:
+                return None
+            if token_cache is not None:
+                token_cache.set(key, result)
+                result = dict(result)
     else:
         result = {}
     result["uid"] = parsed_request["user_id"]
@@ -575,36 +3110,105 @@ def parse_signed_request(signed_request, app_secret):
 
     If the signed_request is malformed or corrupted, False is returned.
 
+    To parse many signed requests with the same app secret, use a
+    SignedRequestVerifier.
+
+    """
+    # HMAC can only handle ascii (byte) strings
+    # http://bugs.python.org/issue5285
+    app_secret = app_secret.encode('ascii')
+    return _verify_signed_request(signed_request, lambda payload: hmac.new(
+        app_secret, msg=payload, digestmod=hashlib.sha256).digest())
+
+
+class SignedRequestVerifier(object):
+    """Verifies and parses signed requests signed with one app secret.
+
+    The keyed HMAC is computed once, the signature is checked (in
+    constant time) before the payload is decoded, and the last
+    `cache_size` verified signed requests are remembered, so that the
+    same cookie arriving on every page view is only verified once:
+
+       verifier = facebook.SignedRequestVerifier(app_secret)
+       data = verifier.parse(cookie)
+
+    Parsed requests are shared between callers and must not be
+    modified. The verifier is safe to share between threads.
+
+    """
+    def __init__(self, app_secret, cache_size=256):
+        # Keyed once; each signature is computed on a copy
+        self._hmac = hmac.new(app_secret.encode('ascii'),
+                              digestmod=hashlib.sha256)
+        self.cache_size = cache_size
+        if cache_size:
+            self._cache = collections.OrderedDict()
+            self._lock = threading.Lock()
+
+    def parse(self, signed_request):
+        """Returns the data in signed_request, or False if it is
+        malformed or its signature doesn't match.
+
+        """
+        if self.cache_size:
+            with self._lock:
+                data = self._cache.pop(signed_request, None)
+                if data is not None:
+                    self._cache[signed_request] = data
+                    return data
+        data = _verify_signed_request(signed_request, self._sign)
+        if data and self.cache_size:
+            with self._lock:
+                self._cache[signed_request] = data
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return data
+
+    def parse_many(self, signed_requests):
+        """Parses each of signed_requests in turn, yielding the data or
+        False for each.
+
+        Meant for reprocessing logs: the cache of recent signed
+        requests is neither consulted nor filled.
+
+        """
+        sign = self._sign
+        for signed_request in signed_requests:
+            yield _verify_signed_request(signed_request, sign)
+
+    def _sign(self, payload):
+        """Returns the HMAC-SHA256 digest of payload."""
+        signer = self._hmac.copy()
+        signer.update(payload)
+        return signer.digest()
+
+
+def _verify_signed_request(signed_request, sign):
+    """Parses signed_request, checking its signature with sign, a
+    function returning the HMAC-SHA256 digest of its payload.
+
     """
     try:
         encoded_sig, payload = map(str, signed_request.split('.', 1))
-
         sig = base64.urlsafe_b64decode(encoded_sig + "=" *
                                        ((4 - len(encoded_sig) % 4) % 4))
-        data = base64.urlsafe_b64decode(payload + "=" *
-                                        ((4 - len(payload) % 4) % 4))
-    except IndexError:
+        expected_sig = sign(payload.encode('ascii'))
+    except (TypeError, ValueError):
         # Signed request was malformed.
         return False
-    except TypeError:
-        # Signed request had a corrupted payload.
+    # Check the signature before decoding anything that it covers
+    if not compare_digest(sig, expected_sig):
         return False
 
-    data = json.loads(data)
-    if data.get('algorithm', '').upper() != 'HMAC-SHA256':
+    try:
+        data = json.loads(base64.urlsafe_b64decode(
+            payload + "=" * ((4 - len(payload) % 4) % 4)).decode('utf-8'))
+    except (TypeError, ValueError):
+        # Signed request had a corrupted payload.
         return False
-
-    # HMAC can only handle ascii (byte) strings
-    # http://bugs.python.org/issue5285
-    app_secret = app_secret.encode('ascii')
-    payload = payload.encode('ascii')
-
-    expected_sig = hmac.new(app_secret,
-                            msg=payload,
-                            digestmod=hashlib.sha256).digest()
-    if sig != expected_sig:
+    if not isinstance(data, dict) or \
+            data.get('algorithm', '').upper() != 'HMAC-SHA256':
         return False
-
     return data
 
 
@@ -618,9 +3222,11 @@ def auth_url(app_id, canvas_url, perms=None, **kwargs):
 
 
 def get_access_token_from_code(code, redirect_uri, app_id, app_secret):
-    return GraphAPI().get_access_token_from_code(
-        code, redirect_uri, app_id, app_secret)
+    with contextlib.closing(GraphAPI()) as graph:
+        return graph.get_access_token_from_code(
+            code, redirect_uri, app_id, app_secret)
 
 
 def get_app_access_token(app_id, app_secret):
-    return GraphAPI().get_app_access_token(app_id, app_secret)
+    with contextlib.closing(GraphAPI()) as graph:
+        return graph.get_app_access_token(app_id, app_secret)
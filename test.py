@@ -14,22 +14,59 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import facebook
+import io
+import json
 import os
+import requests
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-
 try:
-    access_token = os.environ["FACEBOOK_ACCESS_TOKEN"]
-except KeyError:
-    raise Exception("FACEBOOK_ACCESS_TOKEN must be set as an environment "
-                    "variable.")
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "benchmarks"))
+from mockgraph import MockGraphConfig, MockGraphServer
+
+
+# Tests against the live Graph API only run with an access token
+access_token = os.environ.get("FACEBOOK_ACCESS_TOKEN")
 
 
+@unittest.skipUnless(access_token, "FACEBOOK_ACCESS_TOKEN must be set as an "
+                                   "environment variable.")
 class FacebookTestCase(unittest.TestCase):
     def setUp(self):
         self.graph = facebook.GraphAPI(access_token)
 
 
+class MockGraphTestCase(unittest.TestCase):
+    """Runs against a local MockGraphServer instead of the Graph API."""
+    server_class = MockGraphServer
+
+    def mock_config(self):
+        return MockGraphConfig()
+
+    def setUp(self):
+        self.server = self.server_class(self.mock_config()).start()
+        self.graph = facebook.GraphAPI("token", base_url=self.server.url)
+
+    def tearDown(self):
+        self.graph.close()
+        self.server.stop()
+
+    def batch_posts(self):
+        """Returns the args of each batch request the server received."""
+        return [args for method, _, args in self.server.log
+                if method == "POST" and "batch" in args]
+
+
 class SimpleTests(FacebookTestCase):
     # TODO: write more tests to try basic functionality!
     def test_get_object(self):
@@ -37,6 +74,481 @@ class SimpleTests(FacebookTestCase):
         self.assertTrue('id' in result)
 
 
+class SessionTests(MockGraphTestCase):
+    def test_keep_alive(self):
+        for i in range(5):
+            self.graph.get_object(str(i))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_no_keep_alive(self):
+        graph = facebook.GraphAPI("token", base_url=self.server.url,
+                                  keep_alive=False)
+        for i in range(3):
+            graph.get_object(str(i))
+        self.assertEqual(self.server.connections, 3)
+
+    def test_preconnect(self):
+        graph = facebook.GraphAPI("token", base_url=self.server.url,
+                                  preconnect=True)
+        self.assertEqual(self.server.log[0][0], "HEAD")
+        graph.get_object("4")
+        self.assertEqual(self.server.connections, 1)
+        # Failing to warm up is not an error
+        facebook.GraphAPI(base_url="http://127.0.0.1:1", preconnect=True)
+
+    def test_close(self):
+        closed = []
+
+        class Session(requests.Session):
+            def close(self):
+                closed.append(self)
+                super(Session, self).close()
+
+        shared = Session()
+        graph = facebook.GraphAPI("token", base_url=self.server.url,
+                                  session=shared)
+        self.assertEqual(graph.get_object("4")["id"], "4")
+        graph.close()
+        self.assertEqual(closed, [])
+        owned = facebook.GraphAPI("token")
+        owned.session = Session()
+        owned.close()
+        self.assertEqual(len(closed), 1)
+
+
+class RequestTests(MockGraphTestCase):
+    def mock_config(self):
+        return MockGraphConfig(pages=3, page_size=5)
+
+    def test_follow_paging(self):
+        result = self.graph.get_connections("4", "feed")
+        self.assertEqual(len(result["data"]), 15)
+        self.assertEqual(result["pages_seen"], 3)
+        self.assertFalse("paging" in result)
+
+    def test_image(self):
+        result = self.graph.request("4/picture")
+        self.assertEqual(result["data"], MockGraphServer.PICTURE)
+        self.assertEqual(result["mime-type"], "image/jpeg")
+
+    def test_cached_error(self):
+        graph = facebook.GraphAPI("token", base_url=self.server.url,
+                                  cache=facebook.GraphCache())
+        errors = []
+        for _ in range(3):
+            try:
+                graph.get_object("missing")
+            except facebook.GraphAPIError as e:
+                # Annotations by one caller don't reach the next
+                self.assertFalse(hasattr(e, "data"))
+                e.data = ["partial"]
+                errors.append(e)
+        self.assertEqual(len(self.server.log), 1)
+        self.assertEqual([e.type for e in errors], [803, 803, 803])
+
+
+class ResponseTests(MockGraphTestCase):
+    def handle(self, content_type, body, status_code=200):
+        return self.graph._handle_response(
+            status_code, {"content-type": content_type}, body, url="u")
+
+    def test_content_types(self):
+        for content_type in ("application/json; charset=UTF-8",
+                             "text/javascript", ""):
+            self.assertEqual(self.handle(content_type, '{"id": "4"}'),
+                             {"id": "4"})
+        self.assertEqual(self.handle("image/jpeg", "\xff\xd8"),
+                         {"data": "\xff\xd8", "mime-type": "image/jpeg",
+                          "url": "u"})
+        self.assertEqual(self.handle("", "access_token=abc"),
+                         {"access_token": "abc"})
+        self.assertRaises(facebook.GraphAPIError, self.handle,
+                          "application/json", "not json")
+        self.assertRaises(facebook.GraphAPIError, self.handle, "", "garbage")
+
+    def test_text_plain(self):
+        parsed = []
+        parse_querystring = self.graph._parse_querystring
+
+        def counting(body):
+            parsed.append(body)
+            return parse_querystring(body)
+        self.graph._parse_querystring = counting
+        self.assertEqual(self.handle("text/plain; charset=UTF-8",
+                                     "access_token=abc&expires=60"),
+                         {"access_token": "abc", "expires": "60"})
+        # Not a token, so it may still be JSON
+        self.assertEqual(self.handle("text/plain", '{"id": "4"}'),
+                         {"id": "4"})
+        self.assertRaises(facebook.GraphAPIError, self.handle,
+                          "text/plain", "garbage")
+        self.assertEqual(len(parsed), 3)
+
+    def test_batch_headers(self):
+        # The server sends "Content-Type"; sub-responses are still JSON
+        with self.graph as batch:
+            batch.get_object("4")
+            batch.get_object("missing")
+        found, missing = self.graph.execute()
+        self.assertEqual(found["id"], "4")
+        self.assertTrue(isinstance(missing, facebook.GraphAPIError))
+        self.assertEqual(missing.type, 803)
+
+    def test_json_loads(self):
+        decoded = []
+
+        def json_loads(body):
+            decoded.append(body)
+            return json.loads(body)
+        graph = facebook.GraphAPI("token", base_url=self.server.url,
+                                  json_loads=json_loads)
+        graph.get_object("4")
+        with graph as batch:
+            batch.get_object("5")
+            batch.get_object("6")
+        self.assertEqual([result["id"] for result in graph.execute()],
+                         ["5", "6"])
+        # The response, the batch and each of its sub-responses
+        self.assertEqual(len(decoded), 4)
+        graph.close()
+
+
+class GraphCacheTests(MockGraphTestCase):
+    def mock_config(self):
+        return MockGraphConfig(etags=True)
+
+    def cached_graph(self, **kwargs):
+        return facebook.GraphAPI("token", base_url=self.server.url,
+                                 cache=facebook.GraphCache(**kwargs))
+
+    def test_ttl(self):
+        graph = self.cached_graph(ttl=0.1)
+        for _ in range(2):
+            self.assertEqual(graph.get_object("4")["id"], "4")
+        self.assertEqual(len(self.server.log), 1)
+        time.sleep(0.15)
+        graph.get_object("4")
+        self.assertEqual(len(self.server.log), 2)
+
+    def test_eviction(self):
+        graph = self.cached_graph(max_size=2)
+        # 1 was used more recently than 2, so 2 is evicted for 3
+        for id in ["1", "2", "1", "3", "1", "2"]:
+            graph.get_object(id)
+        self.assertEqual([path for _, path, _ in self.server.log],
+                         ["/1", "/2", "/3", "/2"])
+
+    def test_revalidation(self):
+        graph = self.cached_graph(ttl=0)
+        first = graph.get_object("4")
+        second = graph.get_object("4")
+        self.assertEqual(len(self.server.log), 2)
+        self.assertEqual(self.server.not_modified, 1)
+        # The cached result is served again rather than re-downloaded
+        self.assertEqual(second, first)
+
+    def test_unicode_args(self):
+        graph = self.cached_graph()
+        for q in [u"caf\xe9", u"caf\xe9", u"caf\xe8"]:
+            graph.request("search", {"q": q})
+        self.assertEqual([args["q"] for _, _, args in self.server.log],
+                         [b"caf\xc3\xa9", b"caf\xc3\xa8"])
+
+
+class SingleFlightTests(MockGraphTestCase):
+    def mock_config(self):
+        return MockGraphConfig(latency=0.2)
+
+    def setUp(self):
+        super(SingleFlightTests, self).setUp()
+        self.graph.close()
+        self.graph = facebook.GraphAPI("token", base_url=self.server.url,
+                                       single_flight=True)
+
+    def in_threads(self, fn, count=3):
+        outcomes = []
+
+        def run():
+            try:
+                outcomes.append(fn())
+            except BaseException as e:
+                outcomes.append(e)
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_shared(self):
+        # List values are allowed in args
+        results = self.in_threads(
+            lambda: self.graph.request("4", {"ids": ["1", "2"]}))
+        self.assertEqual([result["id"] for result in results], ["4"] * 3)
+        self.assertEqual(len(self.server.log), 1)
+        self.assertEqual(self.graph._in_flight, {})
+
+    def test_copies(self):
+        def fetch():
+            result = self.graph.get_object("4")
+            result["seen_by"] = threading.current_thread().name
+            return result
+        results = self.in_threads(fetch)
+        self.assertEqual(len(self.server.log), 1)
+        self.assertEqual(len(set(result["seen_by"] for result in results)), 3)
+
+    def test_copied_errors(self):
+        def fetch():
+            try:
+                self.graph.get_object("missing")
+            except facebook.GraphAPIError as e:
+                e.seen_by = threading.current_thread().name
+                raise e
+        errors = self.in_threads(fetch)
+        self.assertEqual(len(self.server.log), 1)
+        self.assertEqual([e.type for e in errors], [803] * 3)
+        self.assertEqual(len(set(e.seen_by for e in errors)), 3)
+
+    def test_unicode_args(self):
+        queries = iter([u"caf\xe9", u"caf\xe8"])
+        results = self.in_threads(
+            lambda: self.graph.request("search", {"q": next(queries)}),
+            count=2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(self.server.log), 2)
+
+    def test_interrupted(self):
+        def interrupted(*args):
+            time.sleep(0.1)
+            raise KeyboardInterrupt()
+        self.graph._request = interrupted
+        outcomes = self.in_threads(lambda: self.graph.get_object("4"))
+        self.assertEqual(sorted(type(e).__name__ for e in outcomes),
+                         ["GraphAPIError", "GraphAPIError",
+                          "KeyboardInterrupt"])
+        self.assertEqual(self.graph._in_flight, {})
+
+
+class GetObjectsTests(MockGraphTestCase):
+    def id_requests(self):
+        return [(method, args) for method, _, args in self.server.log
+                if "ids" in args]
+
+    def test_chunks(self):
+        ids = [str(i) for i in range(120)]
+        objects = self.graph.get_objects(ids)
+        self.assertEqual(sorted(objects), sorted(ids))
+        requests = self.id_requests()
+        self.assertEqual([method for method, _ in requests], ["GET"] * 3)
+        self.assertEqual(sorted(len(args["ids"].split(","))
+                                for _, args in requests), [20, 50, 50])
+
+    def test_long_url(self):
+        ids = ["%040d" % i for i in range(50)]
+        objects = self.graph.get_objects(ids)
+        self.assertEqual(sorted(objects), ids)
+        (method, args), = self.id_requests()
+        self.assertEqual(method, "POST")
+        self.assertEqual(args["method"], "GET")
+
+    def test_unicode_args(self):
+        objects = self.graph.get_objects(["1", "2"], q=u"caf\xe9")
+        self.assertEqual(sorted(objects), ["1", "2"])
+        (method, args), = self.id_requests()
+        self.assertEqual((method, args["q"]), ("GET", b"caf\xc3\xa9"))
+        # The length counts the encoded characters
+        self.graph.get_objects(["1", "2"], q=u"\xe9" * 400)
+        self.assertEqual(self.id_requests()[1][0], "POST")
+
+    def test_partial_failure(self):
+        ids = [str(i) for i in range(120)]
+        ids[70] = "missing"
+        try:
+            self.graph.get_objects(ids)
+            self.fail("GraphAPIError not raised")
+        except facebook.GraphAPIError as e:
+            self.assertEqual(sorted(e.data), sorted(ids[:50] + ids[100:]))
+            (chunk, error), = e.errors
+            self.assertEqual(chunk, ids[50:100])
+            self.assertTrue(error is e)
+
+
+class VideoUploadServer(MockGraphServer):
+    """Accepts resumable video uploads in chunks of CHUNK_SIZE bytes.
+
+    Transfers of the offsets in `failing` fail with a temporary error,
+    and those in `slow` take a second.
+    """
+    CHUNK_SIZE = 10
+
+    def __init__(self, config=None):
+        MockGraphServer.__init__(self, config)
+        self.received = {}
+        self.failing = set()
+        self.slow = set()
+
+    def handle(self, method, url, form):
+        phase = form.get("upload_phase")
+        if phase is None:
+            return MockGraphServer.handle(self, method, url, form)
+        with self._lock:
+            self.log.append((method, phase, form))
+        if phase == "start":
+            self.file_size = int(form["file_size"])
+            return 200, self._offsets(0, "1", video_id="2")
+        if phase == "finish":
+            return 200, {"success": True}
+        start = int(form["start_offset"])
+        if start in self.slow:
+            time.sleep(1)
+        if start in self.failing:
+            return 500, {"error": {"message": "Temporary", "code": 2}}
+        self.received[start] = form["video_file_chunk"]
+        return 200, self._offsets(start + len(form["video_file_chunk"]))
+
+    def _offsets(self, start, upload_session_id=None, **result):
+        result.update(start_offset=str(start),
+                      end_offset=str(min(start + self.CHUNK_SIZE,
+                                         self.file_size)))
+        if upload_session_id:
+            result["upload_session_id"] = upload_session_id
+        return result
+
+    def transfers(self):
+        return [int(form["start_offset"]) for _, phase, form in self.log
+                if phase == "transfer"]
+
+    def video(self):
+        return b"".join(self.received[start]
+                        for start in sorted(self.received))
+
+
+class VideoTests(MockGraphTestCase):
+    server_class = VideoUploadServer
+    video = b"0123456789" * 2 + b"01234"
+
+    def test_upload(self):
+        result = self.graph.put_video(io.BytesIO(self.video), title="Test")
+        self.assertEqual(result, {"success": True, "video_id": "2"})
+        self.assertEqual(self.server.transfers(), [0, 10, 20])
+        self.assertEqual(self.server.video(), self.video)
+        self.assertEqual(self.server.log[-1][2]["title"], "Test")
+
+    def test_chunk_size(self):
+        self.graph.put_video(io.BytesIO(self.video), chunk_size=4)
+        self.assertEqual(self.server.transfers(), [0, 4, 8, 12, 16, 20, 24])
+        self.assertEqual(self.server.video(), self.video)
+
+    def test_parallel(self):
+        self.graph.put_video(io.BytesIO(self.video), max_workers=3,
+                             chunk_size=4)
+        self.assertEqual(sorted(self.server.transfers()),
+                         [0, 4, 8, 12, 16, 20, 24])
+        self.assertEqual(self.server.video(), self.video)
+
+    def test_resume_at_end(self):
+        self.graph.put_video(io.BytesIO(self.video), max_workers=2,
+                             upload_session_id="1",
+                             start_offset=len(self.video))
+        self.assertEqual(self.server.transfers(), [])
+
+    def test_failed_chunk(self):
+        # The chunk's retries replace the client's rather than adding up
+        graph = facebook.GraphAPI(
+            "token", base_url=self.server.url,
+            retry_policy=facebook.RetryPolicy(retries=3, backoff=0))
+        self.server.failing.add(10)
+        try:
+            graph.put_video(io.BytesIO(self.video), chunk_retries=1)
+            self.fail("GraphAPIError not raised")
+        except facebook.GraphAPIError as e:
+            self.assertEqual((e.upload_session_id, e.video_id,
+                              e.start_offset), ("1", "2", 10))
+        self.assertEqual(self.server.transfers(), [0, 10, 10])
+
+    def test_timeout(self):
+        graph = facebook.GraphAPI("token", base_url=self.server.url,
+                                  timeout=0.2)
+        self.server.slow.add(10)
+        try:
+            graph.put_video(io.BytesIO(self.video), chunk_retries=0)
+            self.fail("Timeout not raised")
+        except requests.Timeout as e:
+            self.assertEqual((e.upload_session_id, e.start_offset),
+                             ("1", 10))
+
+
+class DownloadTests(MockGraphTestCase):
+    def test_iter_download(self):
+        chunks = list(self.graph.iter_download("4/picture", chunk_size=4))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(b"".join(chunks), MockGraphServer.PICTURE)
+        self.assertEqual(self.server.log[0][2]["access_token"], "token")
+
+    def test_download(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "picture.jpg")
+            result = self.graph.download("4/picture", filename)
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), MockGraphServer.PICTURE)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(result["mime-type"], "image/jpeg")
+        self.assertEqual(result["size"], len(MockGraphServer.PICTURE))
+
+    def test_json_response(self):
+        # An object rather than binary data
+        self.assertRaises(facebook.GraphAPIError, self.graph.download,
+                          "4", tempfile.TemporaryFile())
+        try:
+            list(self.graph.iter_download("missing/picture"))
+            self.fail("GraphAPIError not raised")
+        except facebook.GraphAPIError as e:
+            self.assertEqual(e.type, 803)
+
+    def test_absolute_url(self):
+        # The access token is only sent to the Graph API
+        chunks = self.graph.iter_download(self.server.url + "/4/picture")
+        self.assertEqual(b"".join(chunks), MockGraphServer.PICTURE)
+        self.assertEqual(self.server.log[0][2], {})
+
+
+class FanOutTests(MockGraphTestCase):
+    def mock_config(self):
+        return MockGraphConfig(latency=0.01)
+
+    def test_fan_out(self):
+        results = dict(self.graph.fan_out(["1", "2", "missing"], "feed",
+                                          max_workers=2))
+        self.assertEqual(sorted(results), ["1", "2", "missing"])
+        self.assertEqual(len(results["1"]["data"]), 25)
+        self.assertTrue(isinstance(results["missing"],
+                                   facebook.GraphAPIError))
+
+    def test_stop_early(self):
+        def ids():
+            for i in range(20):
+                yield str(i)
+                # Workers sit idle waiting for the next ID
+                time.sleep(0.2)
+        before = set(threading.enumerate())
+        results = self.graph.fan_out(ids(), "feed", max_workers=4)
+        for id, result in results:
+            break
+        results.close()
+        # Lets the server's threads for our connections finish too
+        self.graph.close()
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            started = set(threading.enumerate()) - before
+            if not started:
+                break
+            time.sleep(0.05)
+        self.assertEqual(started, set())
+
+
 class BatchTests(FacebookTestCase):
     def test_batch_request(self):
         self.assertFalse(self.graph._batch_request)
@@ -59,5 +571,864 @@ class BatchTests(FacebookTestCase):
         self.assertTrue(isinstance(bad_result, facebook.GraphAPIError))
 
 
+class BatchFailingServer(MockGraphServer):
+    """Fails whole batch requests that include a request for "fail"."""
+    def handle(self, method, url, form):
+        if any(request["relative_url"].startswith("fail")
+               for request in json.loads(form.get("batch", "[]"))):
+            return 500, {"error": {"message": "Batch failed", "code": 1}}
+        return MockGraphServer.handle(self, method, url, form)
+
+
+class ExecuteTests(MockGraphTestCase):
+    server_class = BatchFailingServer
+
+    def test_chunks(self):
+        with self.graph:
+            for i in range(120):
+                self.graph.get_object(str(i))
+        results = self.graph.execute()
+        # Split at 50 requests per batch, results in request order
+        self.assertEqual(sorted(len(json.loads(args["batch"]))
+                                for args in self.batch_posts()), [20, 50, 50])
+        self.assertEqual([result["id"] for result in results],
+                         [str(i) for i in range(120)])
+
+    def test_failed_chunk(self):
+        with self.graph:
+            for i in range(120):
+                self.graph.get_object(i == 60 and "fail" or str(i))
+        results = self.graph.execute()
+        for i, result in enumerate(results):
+            if 50 <= i < 100:
+                self.assertTrue(isinstance(result, facebook.GraphAPIError))
+            else:
+                self.assertEqual(result["id"], str(i))
+
+    def test_all_chunks_failed(self):
+        with self.graph:
+            self.graph.get_object("fail")
+        self.assertRaises(facebook.GraphAPIError, self.graph.execute)
+
+
+class BatchDispatcherTests(MockGraphTestCase):
+    def batch_sizes(self):
+        return sorted(len(json.loads(args["batch"]))
+                      for args in self.batch_posts())
+
+    def test_window(self):
+        dispatcher = facebook.BatchDispatcher(self.graph, window=0.2)
+        futures = [dispatcher.get_object(str(i)) for i in range(5)]
+        self.assertEqual([future.result()["id"] for future in futures],
+                         [str(i) for i in range(5)])
+        self.assertEqual(self.batch_sizes(), [5])
+        dispatcher.close()
+
+    def test_max_size(self):
+        dispatcher = facebook.BatchDispatcher(self.graph, window=0.5,
+                                              max_size=100)
+        futures = [dispatcher.get_object(str(i)) for i in range(120)]
+        self.assertEqual([future.result()["id"] for future in futures],
+                         [str(i) for i in range(120)])
+        self.assertEqual(self.batch_sizes(), [20, 50, 50])
+        dispatcher.close()
+
+    def test_errors(self):
+        dispatcher = facebook.BatchDispatcher(self.graph)
+        found = dispatcher.get_object("4")
+        missing = dispatcher.get_object("missing")
+        self.assertEqual(found.result()["id"], "4")
+        self.assertTrue(isinstance(missing.exception(),
+                                   facebook.GraphAPIError))
+        dispatcher.close()
+
+    def test_close(self):
+        # Queued requests are sent without waiting out the window
+        dispatcher = facebook.BatchDispatcher(self.graph, window=60)
+        futures = [dispatcher.get_object(str(i)) for i in range(3)]
+        dispatcher.close()
+        self.assertEqual([future.result(5)["id"] for future in futures],
+                         ["0", "1", "2"])
+        self.assertEqual(self.batch_sizes(), [3])
+        self.assertRaises(facebook.GraphAPIError, dispatcher.get_object, "4")
+
+
+class FlakyBatchServer(MockGraphServer):
+    """Fails the first `failures` batch requests with a temporary error."""
+    failures = 0
+
+    def handle(self, method, url, form):
+        if "batch" in form and self.failures:
+            with self._lock:
+                self.failures -= 1
+                self.log.append((method, url, form))
+            return 500, {"error": {"message": "Temporary", "code": 2}}
+        return MockGraphServer.handle(self, method, url, form)
+
+
+class AttachedFilesTests(MockGraphTestCase):
+    server_class = FlakyBatchServer
+
+    def upload(self, contents):
+        with self.graph:
+            for content in contents:
+                self.graph.request("4/photos", post_args={"caption": "x"},
+                                   files={"source": io.BytesIO(content)},
+                                   method="POST")
+
+    def test_names(self):
+        self.upload([b"first", b"second"])
+        self.assertEqual([request["attached_files"] for request
+                          in self.graph._requests_stack], ["file0", "file1"])
+        self.graph.execute()
+        args, = self.batch_posts()
+        self.assertEqual((args["file0"], args["file1"]),
+                         (b"first", b"second"))
+
+    def test_chunks(self):
+        contents = [str(i).encode("ascii") for i in range(60)]
+        self.upload(contents)
+        self.graph.execute()
+        self.assertEqual(len(self.batch_posts()), 2)
+        # Each batch request carries the files of its own requests only
+        for args in self.batch_posts():
+            names = [request["attached_files"]
+                     for request in json.loads(args["batch"])]
+            self.assertEqual(sorted(name for name in args
+                                    if name.startswith("file")),
+                             sorted(names))
+            for name in names:
+                self.assertEqual(args[name], contents[int(name[4:])])
+
+    def test_retry(self):
+        self.graph.retry_policy = facebook.RetryPolicy(retries=1, backoff=0)
+        self.server.failures = 1
+        photo = io.BytesIO(b"skipped photo")
+        photo.read(8)
+        with self.graph:
+            self.graph.request("4/photos", files={"source": photo},
+                               method="POST")
+        self.graph.execute()
+        failed, retried = self.batch_posts()
+        # Files are sent again from where they were attached
+        self.assertEqual(failed["file0"], b"photo")
+        self.assertEqual(retried["file0"], b"photo")
+
+
+class HookTests(MockGraphTestCase):
+    server_class = FlakyBatchServer
+
+    def mock_config(self):
+        return MockGraphConfig(pages=2)
+
+    def setUp(self):
+        super(HookTests, self).setUp()
+        self.events = []
+        self.graph.add_hook(self.events.append)
+
+    def test_request(self):
+        self.graph.get_object("1234")
+        event, = self.events
+        self.assertEqual(dict((key, event[key]) for key in (
+            "kind", "endpoint", "method", "status", "error", "error_code",
+            "retries", "pages", "batch_size")), {
+            "kind": "request", "endpoint": "/{id}", "method": "GET",
+            "status": 200, "error": None, "error_code": None, "retries": 0,
+            "pages": 1, "batch_size": None})
+        self.assertTrue(event["bytes_in"] > 100)
+        self.assertTrue(event["latency"] >= 0)
+
+    def test_paging(self):
+        self.graph.get_connections("1234", "feed")
+        self.assertEqual([(event["kind"], event["endpoint"], event["pages"])
+                          for event in self.events],
+                         [("page", "/{id}/feed", 1),
+                          ("request", "/{id}/feed", 2)])
+        page, request = self.events
+        self.assertTrue(request["bytes_in"] > page["bytes_in"] > 0)
+
+    def test_error(self):
+        self.assertRaises(facebook.GraphAPIError, self.graph.get_object,
+                          "missing")
+        event, = self.events
+        self.assertEqual((event["status"], event["error_code"]), (404, 803))
+        self.assertTrue(isinstance(event["error"], facebook.GraphAPIError))
+
+    def test_batch(self):
+        self.graph.retry_policy = facebook.RetryPolicy(retries=1, backoff=0)
+        self.server.failures = 1
+        with self.graph:
+            self.graph.get_object("1")
+            self.graph.get_object("2")
+        self.graph.execute()
+        event, = self.events
+        self.assertEqual((event["kind"], event["endpoint"], event["method"],
+                          event["batch_size"], event["retries"]),
+                         ("batch", "/", "POST", 2, 1))
+        self.assertTrue(event["bytes_out"] > 0)
+
+    def test_failing_hook(self):
+        def fail(event):
+            raise ValueError()
+        self.graph.add_hook(fail)
+        self.assertEqual(self.graph.get_object("4")["id"], "4")
+        self.assertEqual(len(self.events), 1)
+
+
+class GraphMetricsTests(unittest.TestCase):
+    def event(self, **values):
+        event = {"kind": "request", "endpoint": "/{id}", "method": "GET",
+                 "status": 200, "latency": 0.2, "bytes_in": 100,
+                 "bytes_out": 0, "error_code": None, "error": None,
+                 "retries": 0, "pages": 1, "batch_size": None}
+        event.update(values)
+        return event
+
+    def test_render_prometheus(self):
+        metrics = facebook.GraphMetrics(buckets=(0.1, 1))
+        metrics(self.event())
+        metrics(self.event(latency=2, retries=2, status=500, error_code=2,
+                           error=facebook.GraphAPIError("Temporary", 500)))
+        lines = metrics.render_prometheus().splitlines()
+        labels = 'kind="request",endpoint="/{id}",method="GET"'
+        for line in [
+                "# TYPE facebook_graph_requests_total counter",
+                'facebook_graph_requests_total{%s,status="200"} 1' % labels,
+                'facebook_graph_requests_total{%s,status="500"} 1' % labels,
+                'facebook_graph_errors_total{%s,error_code="2"} 1' % labels,
+                "facebook_graph_retries_total{%s} 2" % labels,
+                "facebook_graph_received_bytes_total{%s} 200" % labels,
+                "# TYPE facebook_graph_latency_seconds histogram",
+                'facebook_graph_latency_seconds_bucket{%s,le="0.1"} 0'
+                % labels,
+                'facebook_graph_latency_seconds_bucket{%s,le="1"} 1' % labels,
+                'facebook_graph_latency_seconds_bucket{%s,le="+Inf"} 2'
+                % labels,
+                "facebook_graph_latency_seconds_sum{%s} 2.2" % labels,
+                "facebook_graph_latency_seconds_count{%s} 2" % labels]:
+            self.assertTrue(line in lines, line)
+        self.assertFalse(any("batched_requests_total" in line
+                             for line in lines))
+
+    def test_escaping(self):
+        metrics = facebook.GraphMetrics(prefix="fb")
+        metrics(self.event(endpoint='/a"b\\c\nd'))
+        self.assertTrue('fb_pages_total{kind="request",'
+                        'endpoint="/a\\"b\\\\c\\nd",method="GET"} 1'
+                        in metrics.render_prometheus().splitlines())
+
+
+class FieldsTests(unittest.TestCase):
+    def test_fields(self):
+        field = facebook.Field("comments", "message",
+                               facebook.Field("from", "name"), limit=5)
+        self.assertEqual(facebook.fields(["id", field]),
+                         "id,comments.limit(5){message,from{name}}")
+
+
+class QueryTests(MockGraphTestCase):
+    def mock_config(self):
+        return MockGraphConfig(pages=2, page_size=3, item_size=10)
+
+    def sent_fields(self):
+        return [args.get("fields") for _, _, args in self.server.log]
+
+    def test_request_fields(self):
+        self.graph.request("4", {"fields": ["id", facebook.Field(
+            "comments", limit=5)]})
+        self.graph.get_object("4", fields=facebook.Field("likes",
+                                                         summary=True))
+        self.graph.get_object("4", fields="id,name")
+        self.assertEqual(self.sent_fields(), ["id,comments.limit(5)",
+                                              "likes.summary(true)",
+                                              "id,name"])
+
+    def test_dispatcher_fields(self):
+        dispatcher = facebook.BatchDispatcher(self.graph)
+        dispatcher.get_object("4", fields=["id", "name"]).result()
+        dispatcher.close()
+        request, = json.loads(self.batch_posts()[0]["batch"])
+        self.assertEqual(request["relative_url"], "4?fields=id%2Cname")
+
+    def test_query(self):
+        query = self.graph.query("4/feed").fields(
+            "message", facebook.Field("comments", "from", limit=5),
+        ).limit(3).summary().params(since="1")
+        self.assertEqual(query.args(), {
+            "fields": "message,comments.limit(5){from}", "limit": 3,
+            "summary": "true", "since": "1"})
+        result = query.get()
+        self.assertEqual(len(result["data"]), 6)
+        self.assertEqual(self.server.log[0][2]["summary"], "true")
+        self.assertEqual(query.summary(False).args()["summary"], "false")
+
+    def test_query_iteration(self):
+        query = self.graph.query("4/feed").fields("message").limit(3)
+        self.assertEqual([item["id"] for item in query],
+                         ["4_%s" % i for i in range(6)])
+        self.assertEqual([len(page["data"]) for page in query.iter_pages()],
+                         [3, 3])
+        self.assertEqual(self.server.log[0][2]["fields"], "message")
+
+
+class SignedRequestTests(unittest.TestCase):
+    # Signed with the app secret "secret"
+    signed_request = ("TW3ydfr1-mSpylNB8NPoAqATyZIiH1XFO7CLoqmKv18."
+                      "eyJ1c2VyX2lkIjoiNCIsImFsZ29yaXRobSI6"
+                      "IkhNQUMtU0hBMjU2In0")
+
+    def test_parse_signed_request(self):
+        data = facebook.parse_signed_request(self.signed_request, "secret")
+        self.assertEqual(data["user_id"], "4")
+        self.assertFalse(facebook.parse_signed_request(self.signed_request,
+                                                       "other secret"))
+        self.assertFalse(facebook.parse_signed_request("malformed", "secret"))
+
+    def test_verifier(self):
+        verifier = facebook.SignedRequestVerifier("secret")
+        self.assertEqual(verifier.parse(self.signed_request)["user_id"], "4")
+        results = list(verifier.parse_many([self.signed_request,
+                                            self.signed_request[1:]]))
+        self.assertEqual(results[0]["user_id"], "4")
+        self.assertFalse(results[1])
+
+
+class TokenCacheTests(unittest.TestCase):
+    def check_cache(self, cache):
+        key = cache.key("4", "code")
+        self.assertEqual(cache.get(key), None)
+        cache.set(key, {"access_token": "token", "expires": "3600"})
+        self.assertEqual(cache.get(key)["access_token"], "token")
+        # Expired tokens are not served
+        cache.set(key, {"access_token": "token", "expires": "0"})
+        self.assertEqual(cache.get(key), None)
+
+        cache.set(key, {"access_token": "token", "expires": "3600"})
+        cache.clear()
+        self.assertEqual(cache.get(key), None)
+
+    def test_token_cache(self):
+        self.check_cache(facebook.TokenCache())
+
+    def test_shared_token_cache(self):
+        client = facebook.LocalCacheClient()
+        self.check_cache(facebook.SharedTokenCache(client))
+        # Clearing one process's cache clears the others
+        first = facebook.SharedTokenCache(client)
+        second = facebook.SharedTokenCache(client)
+        key = first.key("4", "code")
+        self.assertEqual(key, facebook.TokenCache().key("4", "code"))
+        first.set(key, {"access_token": "token"})
+        self.assertEqual(second.get(key)["access_token"], "token")
+        second.clear()
+        self.assertEqual(first.get(key), None)
+
+
+class AppTokenServer(MockGraphServer):
+    """Issues numbered app access tokens that expire after a second."""
+    def handle(self, method, url, form):
+        status, document = MockGraphServer.handle(self, method, url, form)
+        if self.log[-1][1] == "/oauth/access_token":
+            issued = len([entry for entry in self.log
+                          if entry[1] == "/oauth/access_token"])
+            return 200, {"access_token": "app|%s" % issued,
+                         "token_type": "bearer", "expires_in": 1}
+        return status, document
+
+
+class AppTokenManagerTests(MockGraphTestCase):
+    server_class = AppTokenServer
+
+    def setUp(self):
+        super(AppTokenManagerTests, self).setUp()
+        self.manager = facebook.AppTokenManager("app", "secret",
+                                                base_url=self.server.url)
+        self.graph.close()
+        self.graph = facebook.GraphAPI(base_url=self.server.url,
+                                       token_manager=self.manager)
+
+    def token_fetches(self):
+        return [args for _, path, args in self.server.log
+                if path == "/oauth/access_token"]
+
+    def assertAuthenticated(self, args, access_token):
+        self.assertEqual(args["access_token"], access_token)
+        self.assertEqual(args["appsecret_proof"],
+                         self.manager.appsecret_proof(access_token))
+
+    def test_appsecret_proof(self):
+        manager = facebook.AppTokenManager(None, "secret")
+        proof = manager.appsecret_proof("token")
+        self.assertEqual(proof, "e941110e3d2bfe82621f0e3e1434730d"
+                                "7305d106c5f68c87165d0b27a4611a4a")
+        self.assertEqual(manager.appsecret_proof("token"), proof)
+
+    def test_fetched_once(self):
+        for i in range(3):
+            self.graph.get_object(str(i))
+        fetches = self.token_fetches()
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual((fetches[0]["client_id"],
+                          fetches[0]["client_secret"]), ("app", "secret"))
+        for _, path, args in self.server.log[1:]:
+            self.assertAuthenticated(args, "app|1")
+
+    def test_refresh(self):
+        self.assertEqual(self.manager.get_app_access_token(), "app|1")
+        self.assertEqual(self.manager.get_app_access_token(), "app|1")
+        # Refreshed ahead of its expiry, half a second in
+        time.sleep(0.6)
+        self.assertEqual(self.manager.get_app_access_token(), "app|2")
+        self.assertEqual(len(self.token_fetches()), 2)
+
+    def test_user_token(self):
+        graph = facebook.GraphAPI("user", base_url=self.server.url,
+                                  token_manager=self.manager)
+        graph.get_object("4")
+        graph.close()
+        self.assertEqual(self.token_fetches(), [])
+        self.assertAuthenticated(self.server.log[-1][2], "user")
+
+    def test_batch(self):
+        with self.graph as batch:
+            batch.get_object("4")
+            batch.get_object("5")
+        self.assertEqual([result["id"] for result in self.graph.execute()],
+                         ["4", "5"])
+        post = self.batch_posts()[0]
+        self.assertAuthenticated(post, "app|1")
+        for entry in json.loads(post["batch"]):
+            query = parse_qs(entry["relative_url"].split("?", 1)[1])
+            self.assertAuthenticated(
+                dict((k, v[0]) for k, v in query.items()), "app|1")
+
+
+class TokenPoolTests(unittest.TestCase):
+    def test_rotation(self):
+        pool = facebook.TokenPool(["a", "b", "c"])
+        self.assertEqual([pool.acquire() for _ in range(4)],
+                         ["a", "b", "c", "a"])
+        throttled = facebook.GraphAPIError(
+            {"error": {"message": "Rate limited", "code": 4}})
+        self.assertTrue(pool.report_error("b", throttled))
+        self.assertEqual([pool.acquire() for _ in range(3)], ["c", "a", "c"])
+        invalid = facebook.GraphAPIError(
+            {"error": {"message": "Expired", "code": 190}})
+        self.assertTrue(pool.report_error("c", invalid))
+        self.assertEqual(len(pool), 2)
+
+    def test_peek(self):
+        pool = facebook.TokenPool(["a", "b"])
+        self.assertEqual([pool.peek(), pool.peek(), pool.acquire(),
+                          pool.peek(), pool.acquire()],
+                         ["a", "a", "a", "b", "b"])
+
+
+class RetryPolicyTests(MockGraphTestCase):
+    def mock_config(self):
+        return MockGraphConfig(latency=0.3)
+
+    def test_is_retryable(self):
+        policy = facebook.RetryPolicy()
+        server_error = facebook.GraphAPIError("Bad gateway", 502)
+        unknown_error = facebook.GraphAPIError(
+            {"error": {"message": "Unknown error", "code": 1}}, 500)
+        for error, get, post in [
+                (server_error, True, False),
+                (unknown_error, True, True),
+                (requests.ReadTimeout(), True, False),
+                (requests.ConnectTimeout(), True, True),
+                (requests.ConnectionError(), True, True),
+                (ValueError(), False, False)]:
+            self.assertEqual(policy.is_retryable(error), get)
+            self.assertEqual(policy.is_retryable(error, "POST"), post)
+
+    def test_read_timeout(self):
+        graph = facebook.GraphAPI(
+            "token", base_url=self.server.url, timeout=0.1,
+            retry_policy=facebook.RetryPolicy(retries=2, backoff=0))
+        self.assertRaises(requests.Timeout, graph.get_object, "4")
+        self.assertRaises(requests.Timeout, graph.put_object, "4", "feed",
+                          message="Hello")
+        self.assertEqual([method for method, _, _ in self.server.log],
+                         ["GET", "GET", "GET", "POST"])
+
+
+class UsageTests(unittest.TestCase):
+    def test_update(self):
+        usage = facebook.GraphUsage()
+        usage.update(requests.structures.CaseInsensitiveDict({
+            "X-App-Usage": '{"call_count": 40, "total_time": 25}',
+            "X-Page-Usage": "not JSON",
+            "X-Business-Use-Case-Usage": json.dumps({"123": [{
+                "type": "pages", "call_count": 90, "total_cputime": 10,
+                "estimated_time_to_regain_access": 2}]})}))
+        self.assertEqual(usage.app["call_count"], 40)
+        self.assertEqual(usage.page, {})
+        self.assertEqual(usage.utilization(), 90)
+        self.assertEqual(usage.blocked_until(), usage.updated + 120)
+        # Headers missing from a response keep their last values
+        usage.update({"x-page-usage": '{"call_count": 95}'})
+        self.assertEqual(usage.app["call_count"], 40)
+        self.assertEqual(usage.utilization(), 95)
+
+    def test_not_blocked(self):
+        usage = facebook.GraphUsage()
+        self.assertEqual(usage.utilization(), 0)
+        self.assertEqual(usage.blocked_until(), None)
+        usage.update({"x-business-use-case-usage": json.dumps({"123": [{
+            "call_count": 10, "estimated_time_to_regain_access": 0}]})})
+        self.assertEqual(usage.blocked_until(), None)
+
+
+class RateLimiterTests(unittest.TestCase):
+    def timed(self, limiter, count, usage=None):
+        started = time.time()
+        for _ in range(count):
+            limiter.acquire(usage)
+        return time.time() - started
+
+    def test_pacing(self):
+        limiter = facebook.RateLimiter(rate=100, burst=5)
+        # The burst goes through at once, the rest at 100 per second
+        self.assertTrue(self.timed(limiter, 5) < 0.02)
+        self.assertTrue(0.08 < self.timed(limiter, 10) < 0.2)
+
+    def test_current_rate(self):
+        limiter = facebook.RateLimiter(rate=100, threshold=75, min_rate=1)
+        self.assertEqual(limiter.current_rate(50), 100)
+        self.assertEqual(limiter.current_rate(87.5), 50)
+        self.assertEqual(limiter.current_rate(100), 1)
+        self.assertEqual(limiter.current_rate(120), 1)
+        for threshold in (-1, 100):
+            self.assertRaises(AssertionError, facebook.RateLimiter,
+                              rate=100, threshold=threshold)
+
+    def test_slows_down(self):
+        limiter = facebook.RateLimiter(rate=1000, burst=10, threshold=50)
+        usage = facebook.GraphUsage()
+        usage.update({"x-app-usage": '{"call_count": 99}'})
+        # At 99% utilization the rate drops to 20 per second, and the
+        # burst shrinks with it
+        self.assertTrue(self.timed(limiter, 3, usage) > 0.08)
+
+    def test_blocked(self):
+        limiter = facebook.RateLimiter(rate=1000)
+        usage = facebook.GraphUsage()
+        usage.update({"x-business-use-case-usage": json.dumps({"123": [{
+            "estimated_time_to_regain_access": 0.002}]})})
+        self.assertTrue(self.timed(limiter, 1, usage) > 0.1)
+
+
+class PageSizeTunerTests(unittest.TestCase):
+    def test_apply(self):
+        tuner = facebook.PageSizeTuner(min_limit=10, max_limit=100)
+        self.assertEqual(tuner.apply("https://x/4/feed?after=1"),
+                         "https://x/4/feed?after=1")
+        self.assertEqual(tuner.limit, None)
+        url = tuner.apply("https://x/4/feed?limit=500&after=1")
+        self.assertEqual(tuner.limit, 100)
+        self.assertTrue("limit=100" in url and "after=1" in url)
+
+    def test_grow(self):
+        tuner = facebook.PageSizeTuner(max_limit=100, limit=40)
+        tuner.record(40, 0.1)
+        self.assertEqual(tuner.limit, 60)
+        # Pages that aren't full don't
+        tuner.record(10, 0.1)
+        self.assertEqual(tuner.limit, 60)
+        tuner.record(60, 0.1)
+        self.assertEqual(tuner.limit, 90)
+        tuner.record(90, 0.1)
+        self.assertEqual(tuner.limit, 100)
+
+    def test_shrink(self):
+        tuner = facebook.PageSizeTuner(min_limit=25, target_latency=2,
+                                       limit=100)
+        tuner.record(100, 4)
+        self.assertEqual(tuner.limit, 50)
+        tuner.record(50, 10)
+        self.assertEqual(tuner.limit, 25)
+        self.assertFalse(tuner.shrink())
+        tuner.limit = 60
+        self.assertTrue(tuner.shrink())
+        self.assertEqual(tuner.limit, 30)
+        self.assertTrue(tuner.is_too_large(requests.ReadTimeout()))
+        self.assertTrue(tuner.is_too_large(facebook.GraphAPIError(
+            {"error": {"message": "Reduce the amount of data", "code": 1}})))
+
+    def test_max_bytes(self):
+        tuner = facebook.PageSizeTuner(min_limit=1, limit=100,
+                                       max_bytes=10000)
+        tuner.record(100, 0.1, 40000)
+        self.assertEqual(tuner.limit, 25)
+        # Growth stops at the items that fit
+        tuner.record(25, 0.1, 8000)
+        self.assertEqual(tuner.limit, 31)
+        tuner.record(31, 0.1)
+        self.assertEqual(tuner.limit, 46)
+
+
+class PageLimitServer(MockGraphServer):
+    """Rejects later pages asking for more than 10 items, like the Graph
+    API does when a page would hold too much data.
+    """
+    def handle(self, method, url, form):
+        status, document = MockGraphServer.handle(self, method, url, form)
+        if "after=" in url and int(self.log[-1][2].get("limit", 0)) > 10:
+            return 500, {"error": {"message": "Reduce the amount of data",
+                                   "code": 1}}
+        return status, document
+
+
+class AdaptivePagingTests(MockGraphTestCase):
+    server_class = PageLimitServer
+
+    def mock_config(self):
+        return MockGraphConfig(pages=3, page_size=20, item_size=100)
+
+    def test_too_large(self):
+        tuner = facebook.PageSizeTuner(min_limit=5, limit=40)
+        graph = facebook.GraphAPI("token", base_url=self.server.url,
+                                  adaptive_paging=lambda: tuner,
+                                  retry_policy=facebook.RetryPolicy())
+        started = time.time()
+        result = graph.get_connections("4", "feed")
+        self.assertEqual(result["pages_seen"], 3)
+        # Shrunk on the first rejection, without retries or backoff
+        limits = [int(args["limit"]) for _, _, args in self.server.log[1:]]
+        self.assertEqual(limits[:3], [40, 20, 10])
+        self.assertTrue(time.time() - started < 0.3)
+
+    def test_page_bytes(self):
+        tuner = facebook.PageSizeTuner(min_limit=1, limit=10,
+                                       max_bytes=1000)
+        graph = facebook.GraphAPI("token", base_url=self.server.url,
+                                  adaptive_paging=lambda: tuner)
+        result = graph.get_connections("4", "feed")
+        self.assertEqual(result["pages_seen"], 3)
+        # Items take over 100 bytes, so fewer than 10 fit in 1000 bytes
+        limits = [int(args["limit"]) for _, _, args in self.server.log[1:]]
+        self.assertEqual(limits[0], 10)
+        self.assertTrue(0 < limits[1] < 10)
+
+
+class PagerTests(MockGraphTestCase):
+    ids = ["4_%s" % i for i in range(15)]
+
+    def mock_config(self):
+        return MockGraphConfig(pages=3, page_size=5, item_size=10)
+
+    def items(self, pager, count=None):
+        ids = []
+        for item in pager:
+            ids.append(item["id"])
+            if len(ids) == count:
+                break
+        return ids
+
+    def test_items(self):
+        pager = self.graph.iter_connections("4", "feed")
+        self.assertEqual(self.items(pager), self.ids)
+        self.assertEqual((pager.pages_seen, pager.items_seen), (3, 15))
+        self.assertTrue(pager.done)
+
+    def test_resume_mid_page(self):
+        for count in (3, 7):
+            pager = facebook.GraphPager(self.graph, "4/feed", items=True)
+            self.assertEqual(self.items(pager, count), self.ids[:count])
+            # State survives a round trip through JSON, without the token
+            state = json.loads(json.dumps(pager.state()))
+            self.assertEqual(state["position"], count % 5)
+            self.assertEqual(state["items_seen"], count)
+            self.assertFalse("token" in json.dumps(state))
+            resumed = facebook.GraphPager(self.graph, "4/feed", items=True,
+                                          state=state)
+            self.assertEqual(self.items(resumed), self.ids[count:])
+            self.assertEqual((resumed.pages_seen, resumed.items_seen),
+                             (3, 15))
+        # Resumed requests still send the token
+        self.assertEqual(self.server.log[-1][2]["access_token"], "token")
+
+    def test_resume_at_page_end(self):
+        pager = facebook.GraphPager(self.graph, "4/feed", items=True)
+        self.assertEqual(self.items(pager, 5), self.ids[:5])
+        requests_made = len(self.server.log)
+        resumed = facebook.GraphPager(self.graph, "4/feed", items=True,
+                                      state=pager.state())
+        self.assertEqual(self.items(resumed), self.ids[5:])
+        # The finished page is not fetched again
+        self.assertEqual(len(self.server.log), requests_made + 2)
+
+    def test_checkpoint(self):
+        directory = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(directory, "feed.json")
+            pager = self.graph.iter_pages("4/feed", checkpoint=checkpoint)
+            # A page is saved as done once the next one is asked for
+            for i, page in enumerate(pager):
+                if i == 1:
+                    break
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f)["pages_seen"], 1)
+            # A new pager picks up from the checkpoint
+            pager = self.graph.iter_pages("4/feed", checkpoint=checkpoint)
+            pages = list(pager)
+            self.assertEqual([item["id"] for page in pages
+                              for item in page["data"]], self.ids[5:])
+            self.assertEqual(pager.pages_seen, 3)
+            with open(checkpoint) as f:
+                self.assertTrue(json.load(f)["done"])
+            finished = self.graph.iter_pages("4/feed", checkpoint=checkpoint)
+            self.assertEqual(list(finished), [])
+            self.assertFalse(os.path.exists(checkpoint + ".tmp"))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_checkpoint_every(self):
+        self.assertRaises(AssertionError, self.graph.iter_pages, "4/feed",
+                          checkpoint="feed.json", checkpoint_every=0)
+
+
+class PrefetchTests(MockGraphTestCase):
+    def mock_config(self):
+        return MockGraphConfig(pages=10, page_size=5, item_size=10)
+
+    def page_numbers(self, pages):
+        return [int(page["paging"]["cursors"]["after"]) for page in pages]
+
+    def test_order(self):
+        pages = list(self.graph.iter_pages("4/feed", prefetch=3))
+        self.assertEqual(self.page_numbers(pages), list(range(1, 11)))
+
+    def test_bounded(self):
+        for page in self.graph.iter_pages("4/feed", prefetch=2):
+            time.sleep(0.3)
+            # The page being processed, two buffered and one the worker
+            # is waiting to buffer
+            self.assertEqual(len(self.server.log), 4)
+            break
+
+    def test_stops_after_break(self):
+        self.graph.get_object("4")
+        threads = threading.active_count()
+        for i, page in enumerate(self.graph.iter_pages("4/feed",
+                                                       prefetch=2)):
+            if i == 1:
+                break
+        # The worker gives up on the full buffer and exits
+        time.sleep(0.3)
+        self.assertEqual(threading.active_count(), threads)
+
+
+class BrokenPageServer(MockGraphServer):
+    """Fails the third page of every paged connection."""
+    def handle(self, method, url, form):
+        if "after=2" in url:
+            return 400, {"error": {"message": "Invalid cursor",
+                                   "code": 100}}
+        return MockGraphServer.handle(self, method, url, form)
+
+
+class PrefetchErrorTests(MockGraphTestCase):
+    server_class = BrokenPageServer
+
+    def mock_config(self):
+        return MockGraphConfig(pages=10, page_size=5, item_size=10)
+
+    def test_error(self):
+        pages = []
+        pager = self.graph.iter_pages("4/feed", prefetch=2)
+        try:
+            for page in pager:
+                pages.append(page)
+            self.fail("GraphAPIError not raised")
+        except facebook.GraphAPIError as e:
+            # Raised in our thread, after the pages fetched before it
+            self.assertEqual(e.type, 100)
+            self.assertEqual(e.pages_seen, 2)
+        self.assertEqual([page["paging"]["cursors"]["after"]
+                          for page in pages], ["1", "2"])
+        self.assertFalse(pager.done)
+
+
+class PooledTokenTests(MockGraphTestCase):
+    def mock_config(self):
+        return MockGraphConfig(latency=0.05)
+
+    def pooled_graph(self, **kwargs):
+        return facebook.GraphAPI(base_url=self.server.url,
+                                 token_pool=facebook.TokenPool(["a", "b"]),
+                                 **kwargs)
+
+    def tokens(self):
+        return [args.get("access_token") for _, _, args in self.server.log]
+
+    def test_no_side_effects(self):
+        # Checking for a token and estimating URL lengths don't use one
+        graph = self.pooled_graph()
+        graph.put_object("4", "feed", message="Hello")
+        graph.get_objects(["1", "2"])
+        graph.get_object("4")
+        self.assertEqual(self.tokens(), ["a", "b", "a"])
+
+    def test_cache(self):
+        graph = self.pooled_graph(cache=facebook.GraphCache())
+        for _ in range(3):
+            self.assertEqual(graph.get_object("4")["id"], "4")
+        self.assertEqual(self.tokens(), ["a"])
+
+    def test_single_flight(self):
+        graph = self.pooled_graph(single_flight=True)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(graph.get_object("4")))
+            for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(self.server.log), 1)
+
+
+class PagingTests(FacebookTestCase):
+    def test_iter_connections(self):
+        pager = self.graph.iter_connections("me", "friends", limit=1)
+        friends = list(pager)
+        self.assertGreater(len(friends), 0)
+        self.assertEqual(pager.items_seen, len(friends))
+        self.assertEqual(pager.next_url, None)
+
+
+class AsyncTests(MockGraphTestCase):
+    def setUp(self):
+        super(AsyncTests, self).setUp()
+        self.async_graph = facebook.AsyncGraphAPI("token", concurrency=4,
+                                                  base_url=self.server.url)
+
+    def tearDown(self):
+        self.async_graph.close()
+        super(AsyncTests, self).tearDown()
+
+    def test_get_object(self):
+        futures = [self.async_graph.get_object(str(i)) for i in range(8)]
+        self.assertEqual([future.result()["id"] for future in futures],
+                         [str(i) for i in range(8)])
+
+    def test_error(self):
+        future = self.async_graph.get_object("missing")
+        self.assertTrue(isinstance(future.exception(),
+                                   facebook.GraphAPIError))
+
+    def test_batch(self):
+        with self.async_graph as batch:
+            batch.get_object("1")
+            batch.get_object("missing")
+        results = self.async_graph.execute().result()
+        self.assertEqual(results[0]["id"], "1")
+        self.assertTrue(isinstance(results[1], facebook.GraphAPIError))
+
+
 if __name__ == '__main__':
     unittest.main()